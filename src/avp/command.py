@@ -99,6 +99,38 @@ class Command(QtCore.QObject):
             action="store_true",
             help="disable live preview during export",
         )
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            metavar="N",
+            type=int,
+            help="number of processes used to render frames (0 for one per CPU)",
+        )
+        parser.add_argument(
+            "--segments",
+            metavar="N",
+            type=int,
+            help="split the video into N segments which are rendered and encoded "
+            "in parallel (0 for one per CPU)",
+        )
+        parser.add_argument(
+            "--start",
+            metavar="SECONDS",
+            type=float,
+            help="export the audio from this many seconds in",
+        )
+        parser.add_argument(
+            "--end",
+            metavar="SECONDS",
+            type=float,
+            help="export the audio until this many seconds in",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="keep the segments of an unfinished export beside the output "
+            "file, and only render the missing segments when exporting again",
+        )
 
         args = parser.parse_args()
 
@@ -110,6 +142,17 @@ class Command(QtCore.QObject):
             self.createLogFile()
             quit(0)
 
+        if args.jobs is not None:
+            Core.renderJobs = args.jobs
+        if args.segments is not None:
+            Core.exportSegments = args.segments
+        if args.resume:
+            Core.resumableExport = True
+        if args.start is not None:
+            Core.exportStart = args.start
+        if args.end is not None:
+            Core.exportEnd = args.end
+
         if args.projpath:
             projPath = args.projpath
             if not os.path.dirname(projPath):
@@ -3,7 +3,6 @@ from PIL import Image, ImageDraw
 
 from ..libcomponent import BaseComponent
 from ..toolkit.frame import BlankFrame, FloodFrame
-from ..toolkit.visualizer import createSpectrumArray
 
 
 class Component(BaseComponent):
@@ -68,15 +67,14 @@ class Component(BaseComponent):
         super().preFrameRender(**kwargs)
         smoothConstantDown = 0.08 if not self.smooth else self.smooth / 15
         smoothConstantUp = 0.8 if not self.smooth else self.smooth / 15
-        self.spectrumArray = createSpectrumArray(
+        self.spectrumArray = self.spectrumCache.spectrumArray(
             self,
-            self.completeAudioArray,
             self.sampleSize,
             smoothConstantDown,
             smoothConstantUp,
             self.scale,
-            self.progressBarUpdate,
-            self.progressBarSetText,
+            # drawBars reads every 4th bin
+            bins=range(0, self.bars * 4, 4),
         )
 
     def frameRender(self, frameNo, frame=None):
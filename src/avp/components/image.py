@@ -3,8 +3,7 @@ from PyQt6 import QtWidgets
 import os
 
 from ..libcomponent import BaseComponent
-from ..toolkit.frame import BlankFrame, addShadow
-from ..toolkit.visualizer import createSpectrumArray
+from ..toolkit.frame import BlankFrame, PaddedFrame, addShadow
 
 
 class Component(BaseComponent):
@@ -75,19 +74,15 @@ class Component(BaseComponent):
         # Trigger creation of new base image
         self.existingImage = None
 
-        self.spectrumArray = createSpectrumArray(
-            self,
-            self.completeAudioArray,
-            self.sampleSize,
-            0.08,
-            0.8,
-            self.sensitivity,
-            self.progressBarUpdate,
-            self.progressBarSetText,
+        self.spectrumArray = self.spectrumCache.spectrumArray(
+            self, self.sampleSize, 0.08, 0.8, self.sensitivity, bins=(36 * 4,)
         )
 
     def frameRender(self, frameNo):
-        return self.drawFrame(
+        return PaddedFrame(*self.regionRender(frameNo), self.width, self.height)
+
+    def regionRender(self, frameNo):
+        return self.drawRegion(
             self.width,
             self.height,
             (
@@ -98,7 +93,10 @@ class Component(BaseComponent):
         )
 
     def drawFrame(self, width, height, dynamicScale):
-        frame = BlankFrame(width, height)
+        return PaddedFrame(*self.drawRegion(width, height, dynamicScale), width, height)
+
+    def drawRegion(self, width, height, dynamicScale):
+        """Returns the image and where it goes in the frame"""
         if self.imagePath and os.path.exists(self.imagePath):
             if dynamicScale is not None and self.existingImage:
                 image = self.existingImage
@@ -143,20 +141,25 @@ class Component(BaseComponent):
                     Image.Resampling.LANCZOS,
                 )
 
-            # Paste image at correct position
-            frame.paste(
-                image,
-                box=(
-                    self.xPosition - (0 if not self.respondToAudio else int(scale / 2)),
-                    self.yPosition - (0 if not self.respondToAudio else int(scale / 2)),
-                ),
+            position = (
+                self.xPosition - (0 if not self.respondToAudio else int(scale / 2)),
+                self.yPosition - (0 if not self.respondToAudio else int(scale / 2)),
             )
+            if self.rotate == 0 and not self.shadow:
+                if image.mode != "RGBA":
+                    image = image.convert("RGBA")
+                return image, position
+
+            # Paste image at correct position
+            frame = BlankFrame(width, height)
+            frame.paste(image, box=position)
             if self.rotate != 0:
                 frame = frame.rotate(self.rotate)
             if self.shadow:
                 frame = addShadow(frame, shadBlur, shadX, shadY)
+            return frame, (0, 0)
 
-        return frame
+        return BlankFrame(width, height), (0, 0)
 
     def postFrameRender(self):
         self.existingImage = None
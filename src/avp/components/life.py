@@ -8,7 +8,6 @@ import logging
 
 from ..libcomponent import BaseComponent
 from ..toolkit.frame import BlankFrame, scale, addShadow
-from ..toolkit.visualizer import createSpectrumArray
 
 
 log = logging.getLogger("AVP.Component.Life")
@@ -173,15 +172,8 @@ class Component(BaseComponent):
         if self.sensitivity == 0:
             return
 
-        self.spectrumArray = createSpectrumArray(
-            self,
-            self.completeAudioArray,
-            self.sampleSize,
-            0.08,
-            0.8,
-            20,
-            self.progressBarUpdate,
-            self.progressBarSetText,
+        self.spectrumArray = self.spectrumCache.spectrumArray(
+            self, self.sampleSize, 0.08, 0.8, 20, bins=range(0, 63 * 4, 4)
         )
 
     def properties(self):
@@ -201,8 +193,8 @@ class Component(BaseComponent):
         grid = self.tickGrids[tick]
 
         # Delete old evolution data which we shouldn't need anymore
-        if tick - 60 in self.tickGrids:
-            del self.tickGrids[tick - 60]
+        for oldTick in [t for t in self.tickGrids if t <= tick - 60]:
+            del self.tickGrids[oldTick]
 
         # Fade difference between previous and current grid
         previousGrid = self.tickGrids.get(tick - 1, set())
@@ -501,7 +493,11 @@ class Component(BaseComponent):
         This must compute the previous ticks' grids if not already computed
         """
         if tick - 1 not in self.tickGrids:
-            self.tickGrids[tick - 1] = self.gridForTick(tick - 1)
+            # start from the latest known grid so frames can be rendered
+            # out of order without deep recursion
+            knownTick = max(t for t in self.tickGrids if t < tick - 1)
+            for t in range(knownTick + 1, tick):
+                self.tickGrids[t] = self.gridForTick(t)
 
         lastGrid = self.tickGrids[tick - 1]
 
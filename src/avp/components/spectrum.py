@@ -1,16 +1,16 @@
-from PIL import Image
 import os
 import subprocess
 import logging
 
 from ..libcomponent import BaseComponent
-from ..toolkit.frame import BlankFrame, scale
+from ..toolkit.frame import BlankFrame, PaddedFrame, FrameFromBytes, scale
 from ..toolkit import connectWidget
 from ..toolkit.ffmpeg import (
     openPipe,
     closePipe,
     getAudioDuration,
     FfmpegVideo,
+    FfmpegLayer,
     exampleSound,
 )
 
@@ -105,24 +105,38 @@ class Component(BaseComponent):
             self.previewPipe.wait()
         self.updateChunksize()
         w, h = scale(self.scale, self.width, self.height, str)
-        self.video = FfmpegVideo(
-            inputPath=self.audioFile,
-            filter_=self.makeFfmpegFilter(),
-            width=w,
-            height=h,
-            chunkSize=self.chunkSize,
-            frameRate=int(self.settings.value("outputFrameRate")),
-            parent=self.parent,
-            component=self,
-        )
+        videoArgs = {
+            "filter_": self.makeFfmpegFilter(),
+            "width": w,
+            "height": h,
+            "chunkSize": self.chunkSize,
+            "frameRate": int(self.settings.value("outputFrameRate")),
+            "parent": self.parent,
+            "component": self,
+            "scheduler": self.decoderScheduler,
+        }
+        # these make a frame per output frame, so can share the audio decode.
+        # FFmpeg can abort at the end of Phase's filtergraph, ending the others
+        if self.filterType in (1, 3):
+            self.video = self.ffmpegAudioGraph.video(**videoArgs)
+        else:
+            self.video = FfmpegVideo(
+                inputPath=self.audioFile, startTime=self.audioStart, **videoArgs
+            )
 
     def frameRender(self, frameNo):
+        return PaddedFrame(*self.regionRender(frameNo), self.width, self.height)
+
+    def regionRender(self, frameNo):
         if FfmpegVideo.threadError is not None:
             raise FfmpegVideo.threadError
-        return self.finalizeFrame(self.video.frame(frameNo))
+        return self.finalizeRegion(self.video.frame(frameNo))
 
     def postFrameRender(self):
-        closePipe(self.video.pipe)
+        self.video.close()
+
+    def ffmpegLayer(self):
+        return FfmpegLayer(self.makeFfmpegFilter(), (self.x, self.y))
 
     def getPreviewFrame(self):
         genericPreview = self.settings.value("pref_genericPreview")
@@ -350,16 +364,16 @@ class Component(BaseComponent):
         return changed
 
     def finalizeFrame(self, imageData):
+        return PaddedFrame(*self.finalizeRegion(imageData), self.width, self.height)
+
+    def finalizeRegion(self, imageData):
+        """Returns the spectrum image and where it goes in the frame"""
         try:
-            image = Image.frombytes(
-                "RGBA",
-                scale(self.scale, self.width, self.height, int),
-                imageData,
+            image = FrameFromBytes(
+                imageData, scale(self.scale, self.width, self.height, int)
             )
+            # still the last good frame if no more frames can be read
             self._image = image
         except ValueError:
             image = self._image
-
-        frame = BlankFrame(self.width, self.height)
-        frame.paste(image, box=(self.x, self.y))
-        return frame
+        return image, (self.x, self.y)
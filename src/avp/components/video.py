@@ -1,12 +1,17 @@
-from PIL import Image
 from PyQt6 import QtWidgets
 import os
 import subprocess
 import logging
 
 from ..libcomponent import BaseComponent
-from ..toolkit.frame import BlankFrame, scale
-from ..toolkit.ffmpeg import openPipe, closePipe, testAudioStream, FfmpegVideo
+from ..toolkit.frame import BlankFrame, PaddedFrame, FrameFromBytes, scale
+from ..toolkit.ffmpeg import (
+    openPipe,
+    closePipe,
+    testAudioStream,
+    FfmpegVideo,
+    FfmpegLayer,
+)
 
 
 log = logging.getLogger("AVP.Components.Video")
@@ -99,6 +104,8 @@ class Component(BaseComponent):
         self.video = (
             FfmpegVideo(
                 inputPath=self.videoPath,
+                # frame 0 is at the start of the exported audio, like its audio
+                startTime=self.audioStart,
                 filter_=self.makeFfmpegFilter(),
                 width=self.width,
                 height=self.height,
@@ -107,18 +114,34 @@ class Component(BaseComponent):
                 parent=self.parent,
                 loopVideo=self.loopVideo,
                 component=self,
+                scheduler=self.decoderScheduler,
             )
             if os.path.exists(self.videoPath)
             else None
         )
 
     def frameRender(self, frameNo):
+        return PaddedFrame(*self.regionRender(frameNo), self.width, self.height)
+
+    def regionRender(self, frameNo):
         if FfmpegVideo.threadError is not None:
             raise FfmpegVideo.threadError
-        return self.finalizeFrame(self.video.frame(frameNo))
+        return self.finalizeRegion(self.video.frame(frameNo))
 
     def postFrameRender(self):
-        closePipe(self.video.pipe)
+        self.video.close()
+
+    def ffmpegLayer(self):
+        if self.distort or not os.path.exists(self.videoPath):
+            return None
+        _, filterGraph = self.makeFfmpegFilter()
+        return FfmpegLayer(
+            # the output is labeled like those of the visualizers' filters
+            ["-filter_complex", "%s [v]" % filterGraph, "-map", "[v]"],
+            (self.xPosition, self.yPosition),
+            self.videoPath,
+            self.loopVideo,
+        )
 
     def pickVideo(self):
         imgDir = self.settings.value("componentDir", os.path.expanduser("~"))
@@ -230,23 +253,20 @@ class Component(BaseComponent):
         print("Using audio:\n    path=/filepath/to/video.mp4 audio")
 
     def finalizeFrame(self, imageData):
+        return PaddedFrame(*self.finalizeRegion(imageData), self.width, self.height)
+
+    def finalizeRegion(self, imageData):
+        """Returns the video image and where it goes in the frame"""
         try:
             if self.distort:
-                image = Image.frombytes("RGBA", (self.width, self.height), imageData)
+                image = FrameFromBytes(imageData, (self.width, self.height))
             else:
-                image = Image.frombytes(
-                    "RGBA",
-                    scale(self.scale, self.width, self.height, int),
-                    imageData,
+                image = FrameFromBytes(
+                    imageData, scale(self.scale, self.width, self.height, int)
                 )
+            # no copy is needed for the last good frame (see FfmpegVideo.frame)
             self._image = image
         except ValueError:
             # use last good frame
             image = self._image
-
-        if self.scale != 100 or self.xPosition != 0 or self.yPosition != 0:
-            frame = BlankFrame(self.width, self.height)
-            frame.paste(image, box=(self.xPosition, self.yPosition))
-        else:
-            frame = image
-        return frame
+        return image, (self.xPosition, self.yPosition)
@@ -5,13 +5,13 @@ import subprocess
 import logging
 
 from ..libcomponent import BaseComponent
-from ..toolkit.visualizer import createSpectrumArray
-from ..toolkit.frame import BlankFrame, scale
+from ..toolkit.frame import BlankFrame, PaddedFrame, FrameFromBytes, scale
 from ..toolkit.ffmpeg import (
     openPipe,
     closePipe,
     getAudioDuration,
     FfmpegVideo,
+    FfmpegLayer,
     exampleSound,
 )
 
@@ -77,28 +77,30 @@ class Component(BaseComponent):
         super().preFrameRender(**kwargs)
         self.updateChunksize()
         w, h = scale(self.scale, self.width, self.height, str)
-        self.video = FfmpegVideo(
-            inputPath=self.audioFile,
-            filter_=self.makeFfmpegFilter(),
-            width=w,
-            height=h,
-            chunkSize=self.chunkSize,
-            frameRate=int(self.settings.value("outputFrameRate")),
-            parent=self.parent,
-            component=self,
-            debug=True,
-        )
+        videoArgs = {
+            "filter_": self.makeFfmpegFilter(),
+            "width": w,
+            "height": h,
+            "chunkSize": self.chunkSize,
+            "frameRate": int(self.settings.value("outputFrameRate")),
+            "parent": self.parent,
+            "component": self,
+            "scheduler": self.decoderScheduler,
+        }
+        if self.mode > 1:
+            # showwaves makes a frame per output frame, so can share the audio decode
+            self.video = self.ffmpegAudioGraph.video(**videoArgs)
+        else:
+            self.video = FfmpegVideo(
+                inputPath=self.audioFile,
+                startTime=self.audioStart,
+                debug=True,
+                **videoArgs,
+            )
         if self.speed == 100:
             return
-        self.spectrumArray = createSpectrumArray(
-            self,
-            self.completeAudioArray,
-            self.sampleSize,
-            0.08,
-            0.8,
-            20,
-            self.progressBarUpdate,
-            self.progressBarSetText,
+        self.spectrumArray = self.spectrumCache.spectrumArray(
+            self, self.sampleSize, 0.08, 0.8, 20, bins=range(0, 64 * 4, 4)
         )
 
     def frameRender(self, frameNo):
@@ -116,7 +118,8 @@ class Component(BaseComponent):
             peakValue > 27
             and frameNo - self._lastUpdatedFrame > self.updateInterval / 2
         )
-        if frameDiff == 0 or isValidPeak:
+        # the first frame rendered may not be frame 0 (e.g., in a render process)
+        if frameDiff == 0 or isValidPeak or self._currImage is None:
             self._lastUpdatedFrame = frameNo
             self._fadingImage = self._prevImage
             self._prevImage = self._image
@@ -148,7 +151,17 @@ class Component(BaseComponent):
         return Image.alpha_composite(self._currImage, baseImage)
 
     def postFrameRender(self):
-        closePipe(self.video.pipe)
+        self.video.close()
+
+    def ffmpegLayer(self):
+        if self.speed != 100:
+            # the trail is drawn by frameRender
+            return None
+        return FfmpegLayer(self.makeFfmpegFilter(), (self.x, self.y))
+
+    def warmupFrames(self):
+        # the trail blends the two previous updates into each frame
+        return 0 if self.speed == 100 else self.updateInterval * 2
 
     def getPreviewFrame(self, width, height):
         genericPreview = self.settings.value("pref_genericPreview")
@@ -274,19 +287,28 @@ class Component(BaseComponent):
         width, height = scale(self.scale, self.width, self.height, int)
         self.chunkSize = 4 * width * height
 
+    def regionRender(self, frameNo):
+        if self.speed != 100:
+            # the trail is blended from whole frames
+            return super().regionRender(frameNo)
+        if FfmpegVideo.threadError is not None:
+            raise FfmpegVideo.threadError
+        return self.finalizeRegion(self.video.frame(frameNo))
+
     def finalizeFrame(self, imageData):
+        return PaddedFrame(*self.finalizeRegion(imageData), self.width, self.height)
+
+    def finalizeRegion(self, imageData):
+        """Returns the waveform image and where it goes in the frame"""
         try:
-            image = Image.frombytes(
-                "RGBA",
-                scale(self.scale, self.width, self.height, int),
-                imageData,
+            image = FrameFromBytes(
+                imageData, scale(self.scale, self.width, self.height, int)
             )
+            if self.speed != 100:
+                # the trail keeps frames after the FfmpegVideo reuses their memory
+                image = image.copy()
+            # kept intact as the last good frame once the FfmpegVideo stops
             self._image = image
         except ValueError:
             image = self._image
-        if self.scale != 100 or self.x != 0 or self.y != 0:
-            frame = BlankFrame(self.width, self.height)
-            frame.paste(image, box=(self.x, self.y))
-        else:
-            frame = image
-        return frame
+        return image, (self.x, self.y)
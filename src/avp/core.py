@@ -437,14 +437,16 @@ class Core:
         with open(os.path.join(wd, "encoder-options.json")) as json_file:
             encoderOptions = json.load(json_file)
 
-        # Locate FFmpeg
-        ffmpegBin = findFfmpeg()
+        # Locate FFmpeg, whose capabilities are saved in the data dir
+        ffmpegCache = os.path.join(dataDir, "ffmpeg-cache.json")
+        ffmpegBin = findFfmpeg(ffmpegCache)
         if not ffmpegBin:
             print("Could not find FFmpeg")
 
         settings = {
             "canceled": False,
             "FFMPEG_BIN": ffmpegBin,
+            "ffmpegCache": ffmpegCache,
             "dataDir": dataDir,
             "settings": QtCore.QSettings(
                 os.path.join(dataDir, "settings.ini"),
@@ -460,8 +462,19 @@ class Core:
                 "854x480",
             ],
             "logDir": os.path.join(dataDir, "log"),
+            # decoded audio and spectrum analyses (see toolkit.cache)
+            "cacheDir": os.path.join(dataDir, "cache"),
             "logEnabled": False,
             "previewEnabled": True,
+            # number of render processes, or None to use pref_renderJobs
+            "renderJobs": None,
+            # number of segments encoded in parallel, or None to use pref_exportSegments
+            "exportSegments": None,
+            # whether exports can be resumed, or None to use pref_resumableExport
+            "resumableExport": None,
+            # seconds of the audio to export, or None for the start or end of it
+            "exportStart": None,
+            "exportEnd": None,
         }
 
         settings["videoFormats"] = toolkit.appendUppercase(
@@ -533,6 +546,20 @@ class Core:
             "pref_insertCompAtTop": True,
             "pref_genericPreview": True,
             "pref_undoLimit": 10,
+            "pref_renderJobs": 1,
+            "pref_decodeJobs": 1,
+            "pref_videoDecoders": 0,
+            "pref_nativeExport": False,
+            "pref_writerQueueDepth": 8,
+            "pref_readAheadFrames": 8,
+            "pref_exportSegments": 1,
+            "pref_resumableExport": False,
+            "pref_skipRepeatedFrames": False,
+            "pref_halfPrecisionSpectrum": False,
+            "pref_streamingSpectrum": True,
+            "pref_analysisCache": True,
+            # in MiB
+            "pref_analysisCacheSize": 2048,
         }
 
         for parm, value in cls.defaultSettings.items():
@@ -640,6 +640,9 @@ class MainWindow(QtWidgets.QMainWindow):
         self.canceled = False
         self.progressBarUpdated(-1)
         self.videoWorker = self.core.newVideoWorker(self, audioFile, outputPath)
+        # an end of 0 means the end of the audio
+        self.videoWorker.startTime = self.doubleSpinBox_exportStart.value()
+        self.videoWorker.endTime = self.doubleSpinBox_exportEnd.value() or None
         self.videoWorker.progressBarUpdate.connect(self.progressBarUpdated)
         self.videoWorker.progressBarSetText.connect(self.progressBarSetText)
         self.videoWorker.imageCreated.connect(self.showPreviewImage)
@@ -673,6 +676,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.toolButton_selectAudioFile.setEnabled(False)
             self.label_outputFile.setEnabled(False)
             self.toolButton_selectOutputFile.setEnabled(False)
+            self.doubleSpinBox_exportStart.setEnabled(False)
+            self.doubleSpinBox_exportEnd.setEnabled(False)
             self.lineEdit_audioFile.setEnabled(False)
             self.lineEdit_outputFile.setEnabled(False)
             self.listWidget_componentList.setEnabled(False)
@@ -700,6 +705,8 @@ class MainWindow(QtWidgets.QMainWindow):
             self.label_outputFile.setEnabled(True)
             self.toolButton_selectOutputFile.setEnabled(True)
             self.lineEdit_outputFile.setEnabled(True)
+            self.doubleSpinBox_exportStart.setEnabled(True)
+            self.doubleSpinBox_exportEnd.setEnabled(True)
             self.pushButton_addComponent.setEnabled(True)
             self.pushButton_removeComponent.setEnabled(True)
             self.pushButton_listMoveDown.setEnabled(True)
@@ -14,6 +14,8 @@ from .metaclass import ComponentMetaclass
 from .actions import ComponentUpdate
 from .exceptions import ComponentError
 from ..toolkit.frame import BlankFrame
+from ..toolkit.visualizer import SpectrumCache
+from ..toolkit.ffmpeg import FfmpegAudioGraph
 
 from ..toolkit import (
     getWidgetValue,
@@ -105,24 +107,71 @@ class Component(QtCore.QObject, metaclass=ComponentMetaclass):
         Must call super() when subclassing
         Triggered only before a video is exported (video_thread.py)
             self.audioFile = filepath to the main input audio file
+            self.audioStart = seconds into the audio file where frame 0 begins
             self.completeAudioArray = a list of audio samples
             self.sampleSize = number of audio samples per video frame
             self.progressBarUpdate = signal to set progress bar number
             self.progressBarSetText = signal to set progress bar text
-        Use the latter two signals to update the MainWindow if needed
+            self.spectrumCache = SpectrumCache shared by the export's components
+            self.ffmpegAudioGraph = FfmpegAudioGraph shared by the export's components
+            self.decoderScheduler = DecoderScheduler of the export's FfmpegVideos
+        Use the progress bar signals to update the MainWindow if needed
         for a long initialization procedure (i.e., for a visualizer)
         """
+        self.audioStart = 0.0
+        self.spectrumCache = None
+        self.ffmpegAudioGraph = None
+        # None lets every FfmpegVideo decode whenever it can
+        self.decoderScheduler = None
         for key, value in kwargs.items():
             setattr(self, key, value)
+        if self.spectrumCache is None:
+            # not exported by a video thread, so there is nothing to share
+            self.spectrumCache = SpectrumCache(
+                kwargs.get("completeAudioArray"),
+                kwargs.get("progressBarUpdate"),
+                kwargs.get("progressBarSetText"),
+            )
+        if self.ffmpegAudioGraph is None:
+            self.ffmpegAudioGraph = FfmpegAudioGraph(
+                kwargs.get("audioFile"), self.audioStart
+            )
 
     def frameRender(self, frameNo):
         audioArrayIndex = frameNo * self.sampleSize
         image = BlankFrame(self.width, self.height)
         return image
 
+    def regionRender(self, frameNo):
+        """
+        Returns the frame as an (image, (x, y)) tuple, where the image can be
+        smaller than the output and is placed at (x, y). Components whose
+        content covers a small part of the frame can override this so the
+        video thread only blends that part. By default it is frameRender()
+        """
+        return self.frameRender(frameNo), (0, 0)
+
     def postFrameRender(self):
         pass
 
+    def warmupFrames(self):
+        """
+        Number of preceding frames this component must render before it can
+        render an arbitrary frame the same way as during a sequential export.
+        Used when frames are rendered out of order (e.g., by a render pool)
+        """
+        return 0
+
+    def ffmpegLayer(self):
+        """
+        Returns an FfmpegLayer (toolkit/ffmpeg.py) describing how FFmpeg can
+        draw the same frames as frameRender, so an export of components which
+        are all static or have one never passes frames through Python.
+        Called before preFrameRender, which isn't called for such an export.
+        None means only frameRender can draw the frames
+        """
+        return None
+
     # =~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~
     # Properties
     # =~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~
@@ -0,0 +1,242 @@
+"""
+Exports a video whose every frame FFmpeg can draw by itself, so no frame
+passes through Python and the export is only as slow as the encoder.
+
+This is possible when each component is either static or can describe its
+frames as an FFmpeg filtergraph (see Component.ffmpegLayer). The frames of
+the static components are rendered once and saved as images, then the layers
+are compiled into one filtergraph which overlays them from the bottom up.
+It is the video input of the usual FFmpeg command, which mixes the audio.
+"""
+
+import subprocess as sp
+import math
+import os
+import sys
+import shutil
+import tempfile
+import logging
+
+from .toolkit.ffmpeg import openPipe, escapeFilterValue, renameFilterLabels
+
+
+log = logging.getLogger("AVP.NativeExport")
+
+
+def findFfmpegLayers(components):
+    """
+    Returns a dict of the FfmpegLayer of each component that isn't static,
+    or None if a component can only be drawn by its frameRender method
+    """
+    layers = {}
+    for comp in components:
+        props = comp.properties()
+        if "static" in props:
+            continue
+        if "composite" in props:
+            return None
+        layer = comp.ffmpegLayer()
+        if layer is None:
+            return None
+        layers[comp] = layer
+    return layers
+
+
+class NativeExport:
+    """
+    Exports the video for a video thread Worker which has already determined
+    the length of the audio, given the FfmpegLayers of its components that
+    aren't static (see findFfmpegLayers). run() blocks until FFmpeg is done,
+    and returns False if the export was already ended because it couldn't be
+    started, like Worker.exportStillImage.
+    """
+
+    def __init__(self, worker, layers, duration):
+        self.worker = worker
+        self.layers = layers
+        self.duration = duration
+        self.frameCount = len(range(0, worker.audioArrayLen, worker.sampleSize))
+        # frames before this are the pre-roll of a partial export
+        self.firstFrameNo = worker.firstFrameNo
+        self.frameRate = int(worker.settings.value("outputFrameRate"))
+
+    def run(self):
+        worker = self.worker
+        # only the static components are prepared, to render their frames
+        worker.preFrameRender(nativeComponents=self.layers)
+        if worker.canceled:
+            return False
+        tempDir = tempfile.mkdtemp(prefix="avp-native-")
+        try:
+            ffmpegCommand = worker.createFfmpegCommand(
+                self.duration, filterGraph=self.createFilterGraph(tempDir)
+            )
+            if not ffmpegCommand:
+                return False
+            # progress is written to stdout as lines of key=value
+            ffmpegCommand[1:1] = ["-progress", "pipe:1", "-nostats"]
+            cmd = " ".join(ffmpegCommand)
+            print("###### FFMPEG COMMAND ######\n%s" % cmd)
+            print("############################")
+            log.info(cmd)
+            self.encode(ffmpegCommand)
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+        worker.postFrameRender(nativeComponents=self.layers)
+        return True
+
+    def createFilterGraph(self, tempDir):
+        """
+        Returns a filtergraph drawing every frame of the export, saving the
+        frames of the static components as images in tempDir
+        """
+        worker = self.worker
+        exportFrames = self.frameCount - self.firstFrameNo
+        filterGraphs = [
+            "color=c=black@0:s=%sx%s:r=%s, format=rgba, trim=end_frame=%s [bg]"
+            % (worker.width, worker.height, self.frameRate, exportFrames)
+        ]
+        components = list(reversed(worker.components))
+        # the visualizers share one decode of the export's audio
+        audioLayers = [
+            comp
+            for comp in components
+            if comp in self.layers and self.layers[comp].inputPath is None
+        ]
+        if audioLayers:
+            # the seek lands before the start, which atrim then finds exactly
+            trim = (
+                ":seek_point={0:.3f}, atrim=start={0:.3f}, asetpts=PTS-STARTPTS".format(
+                    worker.audioStart
+                )
+                if worker.audioStart
+                else ""
+            )
+            filterGraphs.append(
+                "amovie=%s%s, asplit=%s %s"
+                % (
+                    escapeFilterValue(worker.inputFile),
+                    trim,
+                    len(audioLayers),
+                    "".join("[a%s]" % components.index(comp) for comp in audioLayers),
+                )
+            )
+
+        background = "bg"
+        for layerNo, comp in enumerate(components):
+            if comp in self.layers:
+                filterGraphs.extend(self.createLayerGraph(layerNo, self.layers[comp]))
+                offset = self.layers[comp].offset
+            else:
+                layer = worker.staticComponents.get(layerNo)
+                if layer is None or layer.transparent:
+                    # merged into a following layer, or not drawn at all
+                    continue
+                imagePath = os.path.join(tempDir, "layer%s.png" % layerNo)
+                layer.image.save(imagePath, compress_level=1)
+                # overlay repeats the only frame of the image until the end
+                filterGraphs.append(
+                    "movie=%s, format=rgba [l%s]"
+                    % (escapeFilterValue(imagePath), layerNo)
+                )
+                offset = layer.offset
+            filterGraphs.append(
+                "[%s][l%s] overlay=x=%s:y=%s:format=auto [bg%s]"
+                % (background, layerNo, *offset, layerNo)
+            )
+            background = "bg%s" % layerNo
+        filterGraphs.append("[%s] format=rgba [out0]" % background)
+        return "; ".join(filterGraphs)
+
+    def createLayerGraph(self, layerNo, layer):
+        """Returns the filtergraphs drawing an FfmpegLayer as [l<layerNo>]"""
+        filterGraphs = []
+        # frames of the layer before the first frame of the export
+        skipFrames = self.firstFrameNo
+        if layer.inputPath is None:
+            inputLabel = "a%s" % layerNo
+        else:
+            inputLabel = "m%s" % layerNo
+            audioStart = self.worker.audioStart
+            if layer.loop:
+                # each loop starts at the seek point, so a looping video skips
+                # the frames before audioStart like an FfmpegVideo
+                options = ":loop=0"
+                skipFrames += math.ceil(round(audioStart * self.frameRate, 3))
+            elif audioStart:
+                # the seek lands on a keyframe before audioStart. An FfmpegVideo
+                # counts frames at the export's frame rate rather than reading
+                # their timestamps, so this is the same frame if the rates match
+                options = ":seek_point={0:.3f}, trim=start={0:.3f}".format(audioStart)
+            else:
+                options = ""
+            filterGraphs.append(
+                "movie=%s%s [%s]"
+                % (escapeFilterValue(layer.inputPath), options, inputLabel)
+            )
+        filter_ = layer.filter_
+        filterGraphs.append(
+            renameFilterLabels(
+                filter_[filter_.index("-filter_complex") + 1], layerNo, inputLabel
+            )
+        )
+        # like an FfmpegVideo, the nth frame drawn is frame n of the export
+        if layer.inputPath is None:
+            # visualizer filters may skip timestamps, which FfmpegVideo fills in
+            # with repeated frames. Filling them in here may draw a frame up to
+            # one frame away from the one frameRender would draw
+            timing = (
+                "setpts=PTS*FRAME_RATE/{0}, fps={0}:start_time=0:round=up".format(
+                    self.frameRate
+                )
+            )
+        else:
+            timing = "setpts=N/%s/TB" % self.frameRate
+        # fps may fill in frames long after the audio ends, or a looping video
+        # may never end, so every layer ends with the export
+        timing += ", trim=start_frame=%s:end_frame=%s, setpts=PTS-STARTPTS" % (
+            skipFrames,
+            skipFrames + self.frameCount - self.firstFrameNo,
+        )
+        filterGraphs.append(
+            "%s %s [l%s]"
+            % (
+                renameFilterLabels(
+                    filter_[filter_.index("-map") + 1], layerNo, inputLabel
+                ),
+                timing,
+                layerNo,
+            )
+        )
+        return filterGraphs
+
+    def encode(self, ffmpegCommand):
+        worker = self.worker
+        exportFrames = self.frameCount - self.firstFrameNo
+        worker.progressBarSetText.emit("Exporting video...")
+        # kept by the worker so cancel() can terminate it
+        worker.out_pipe = pipe = openPipe(
+            ffmpegCommand, stdout=sp.PIPE, stderr=sys.stdout, text=True
+        )
+        progressBarValue = 0
+        for line in pipe.stdout:
+            key, _, value = line.strip().partition("=")
+            if key != "frame" or not value.isdigit():
+                continue
+            completion = int(value) * 100 // exportFrames
+            if completion > progressBarValue:
+                progressBarValue = min(completion, 100)
+                worker.progressBarUpdate.emit(progressBarValue)
+                worker.progressBarSetText.emit(
+                    "Exporting video: %s%%" % progressBarValue
+                )
+        pipe.stdout.close()
+        returnCode = pipe.wait()
+        worker.out_pipe = None
+        if returnCode != 0 and not worker.canceled:
+            # FIXME video_thread should own this error signal, not components
+            worker.components[0]._error.emit(
+                "FFmpeg could not export the video.",
+                "Exit code: %s" % returnCode,
+            )
+            worker.error = True
@@ -0,0 +1,304 @@
+"""
+Pool of processes used by the video thread to render frames in parallel.
+
+Each render process opens its own copy of the project and calls frameRender
+on its own component stack. Frames are handed out in blocks: process N renders
+blocks N, N + jobs, N + 2 * jobs... into a ring of shared memory slots, and
+the video thread reads the slots back in frame order before piping to FFmpeg.
+"""
+
+from PyQt6 import QtCore
+from multiprocessing import shared_memory
+from collections import deque
+import multiprocessing
+import numpy
+import os
+import sys
+import queue
+import shutil
+import signal
+import tempfile
+import logging
+
+from .toolkit import formatTraceback
+
+
+log = logging.getLogger("AVP.RenderPool")
+
+
+class RenderPool:
+    """
+    Starts render processes for a video thread Worker which has already
+    determined the length of the audio. Use nextFrame() to get each frame in
+    order and releaseFrame() once it has been written (possibly from another
+    thread), then close() when the export is done.
+    """
+
+    def __init__(self, worker, jobs, blockSize=15):
+        self.worker = worker
+        self.jobs = jobs
+        self.blockSize = blockSize
+        self.frameSize = worker.width * worker.height * 4
+        self.frameCount = len(range(0, worker.audioArrayLen, worker.sampleSize))
+        # frames before this are the pre-roll of a partial export
+        self.firstFrameNo = worker.firstFrameNo
+        # each process needs room for one whole block while the others are read
+        self.slots = blockSize
+        self.frameNo = self.firstFrameNo
+        # frames given out by nextFrame() which haven't been released yet
+        self.pendingFrames = deque()
+        self.error = None
+
+        # Render processes read the project from disk and share settings.ini
+        self.tempDir = tempfile.mkdtemp(prefix="avp-render-")
+        projectPath = os.path.join(self.tempDir, "render.avp")
+        worker.core.createProjectFile(projectPath)
+        worker.settings.sync()
+
+        context = multiprocessing.get_context("spawn")
+        self.errors = context.Queue()
+        self.sharedMemory = []
+        self.filled = []
+        self.free = []
+        self.processes = []
+        self.currentSlot = []
+        for procNo in range(jobs):
+            shm = shared_memory.SharedMemory(
+                create=True, size=self.frameSize * self.slots
+            )
+            filled = context.Semaphore(0)
+            free = context.Semaphore(self.slots)
+            process = context.Process(
+                target=renderProcess,
+                name="AVP Render Process #%s" % procNo,
+                args=(
+                    procNo,
+                    jobs,
+                    blockSize,
+                    self.slots,
+                    self.firstFrameNo,
+                    self.frameCount,
+                    projectPath,
+                    type(worker.core).dataDir,
+                    worker.inputFile,
+                    (worker.startTime, worker.endTime),
+                    shm.name,
+                    filled,
+                    free,
+                    self.errors,
+                ),
+            )
+            process.daemon = True
+            self.sharedMemory.append(shm)
+            self.filled.append(filled)
+            self.free.append(free)
+            self.processes.append(process)
+            self.currentSlot.append(0)
+
+        log.info(
+            "Starting %s render processes for %s frames", jobs, self.frameCount
+        )
+        for process in self.processes:
+            process.start()
+
+    def procNoForFrame(self, frameNo):
+        return ((frameNo - self.firstFrameNo) // self.blockSize) % self.jobs
+
+    def nextFrame(self):
+        """
+        Returns a memoryview of the next frame in order, or None if the export
+        was canceled or a render process failed (the reason is in self.error)
+        """
+        procNo = self.procNoForFrame(self.frameNo)
+        while not self.filled[procNo].acquire(timeout=0.25):
+            if self.worker.canceled or self.checkErrors(procNo):
+                return None
+        offset = self.currentSlot[procNo] * self.frameSize
+        frameData = self.sharedMemory[procNo].buf[offset : offset + self.frameSize]
+        self.currentSlot[procNo] = (self.currentSlot[procNo] + 1) % self.slots
+        self.frameNo += 1
+        self.pendingFrames.append((procNo, frameData))
+        return frameData
+
+    def releaseFrame(self):
+        """Gives the slot of the oldest unreleased frame back to its process"""
+        procNo, frameData = self.pendingFrames.popleft()
+        frameData.release()
+        self.free[procNo].release()
+
+    def checkErrors(self, procNo):
+        try:
+            self.error = self.errors.get_nowait()
+        except queue.Empty:
+            if self.processes[procNo].is_alive():
+                return False
+            self.error = (
+                "Render process #%s exited unexpectedly." % procNo,
+                "Exit code: %s" % self.processes[procNo].exitcode,
+            )
+        log.error("Render pool failed: %s", self.error[0])
+        return True
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for shm in self.sharedMemory:
+            shm.close()
+            shm.unlink()
+        self.errors.close()
+        shutil.rmtree(self.tempDir, ignore_errors=True)
+        log.info("Render pool closed")
+
+
+def renderProcess(
+    procNo,
+    jobs,
+    blockSize,
+    slots,
+    firstFrameNo,
+    frameCount,
+    projectPath,
+    dataDir,
+    inputFile,
+    timeRange,
+    shmName,
+    filled,
+    free,
+    errors,
+):
+    """Entry point of each render process created by RenderPool"""
+    shm = shared_memory.SharedMemory(name=shmName)
+    slotFrames = []
+    worker = None
+    try:
+        worker = startRenderWorker(
+            "Render process #%s" % procNo,
+            projectPath,
+            dataDir,
+            inputFile,
+            timeRange,
+            frameCount,
+            errors,
+        )
+        if worker is None:
+            return
+
+        frameSize = worker.width * worker.height * 4
+        # frames are composited straight into the shared memory slots
+        slotFrames = [
+            numpy.ndarray(
+                (worker.height, worker.width, 4),
+                dtype="uint8",
+                buffer=shm.buf,
+                offset=slot * frameSize,
+            )
+            for slot in range(slots)
+        ]
+        lastFrameNo = -1
+        slot = 0
+        for blockStart in range(
+            firstFrameNo + procNo * blockSize, frameCount, jobs * blockSize
+        ):
+            warmUpComponents(worker.components, blockStart, lastFrameNo)
+            for frameNo in range(blockStart, min(blockStart + blockSize, frameCount)):
+                free.acquire()
+                worker.frameRender(frameNo * worker.sampleSize, slotFrames[slot])
+                if worker.error:
+                    return
+                filled.release()
+                slot = (slot + 1) % slots
+                lastFrameNo = frameNo
+
+        worker.postFrameRender()
+    except Exception as e:
+        errors.put(
+            (
+                "Render process #%s encountered %s: %s"
+                % (procNo, e.__class__.__name__, str(e)),
+                formatTraceback(),
+            )
+        )
+    finally:
+        if worker is not None:
+            # removes analyses this process didn't finish from the cache
+            worker.closeSpectrumCache()
+        # the views must be gone before the shared memory can be closed
+        del slotFrames
+        shm.close()
+
+
+def startRenderWorker(
+    name, projectPath, dataDir, inputFile, timeRange, frameCount, errors
+):
+    """
+    Sets up a process which renders frames of the project saved at projectPath,
+    exporting the (start, end) timeRange of the audio in seconds, up to frame
+    number frameCount (the video thread counts the frames from the probed
+    duration of the audio, without decoding it).
+    Returns a video thread Worker whose components are ready for frameRender,
+    or None if they couldn't be started (the reason is put in errors)
+    """
+    # The video thread handles Ctrl+C and terminates us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # being terminated raises SystemExit, so the process still cleans up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(-signum))
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    from .core import Core
+    from .command import Command
+    from .video_thread import Worker
+
+    class RenderProcessCommand(Command):
+        """Stands in for the GUI or Command object in a render process"""
+
+        @QtCore.pyqtSlot(str, str)
+        def videoThreadError(self, msg, detail):
+            errors.put((msg, detail))
+
+        def stopVideo(self, *args):
+            # Command handles Ctrl+C with this, which the video thread handles
+            pass
+
+    Core.storeSettings(dataDir)
+    Core.previewEnabled = False
+    app = QApplication(sys.argv[:1])
+    loader = RenderProcessCommand()
+    if not loader.core.openProject(loader, projectPath):
+        errors.put(("%s could not open the project." % name, ""))
+        return
+    worker = Worker(loader, inputFile, None, loader.core.selectedComponents)
+    # keep the application alive as long as the worker
+    worker.app = app
+    worker.width = int(loader.settings.value("outputWidth"))
+    worker.height = int(loader.settings.value("outputHeight"))
+    worker.startTime, worker.endTime = timeRange
+    worker.reset()
+    worker.duration = worker.determineAudioLength()
+    if not worker.duration:
+        errors.put(("%s could not load the audio." % name, ""))
+        return
+    audioArrayLen = frameCount * worker.sampleSize
+    if len(worker.completeAudioArray) and worker.audioArrayLen < audioArrayLen:
+        # the audio is shorter than probed, so the frames after it are silent
+        worker.completeAudioArray = numpy.pad(
+            worker.completeAudioArray, (0, audioArrayLen - worker.audioArrayLen)
+        )
+        worker.audioArrayLen = audioArrayLen
+    worker.preFrameRender()
+    if worker.canceled:
+        # the component has already reported its error
+        return
+    return worker
+
+
+def warmUpComponents(components, frameNo, lastFrameNo=-1):
+    """
+    Renders the frames before frameNo which stateful components need in
+    order to render it, skipping any up to lastFrameNo which were rendered
+    """
+    for comp in components:
+        warmup = comp.warmupFrames()
+        for warmupFrameNo in range(max(lastFrameNo + 1, frameNo - warmup), frameNo):
+            comp.frameRender(warmupFrameNo)
@@ -0,0 +1,379 @@
+"""
+Splits the timeline of an export into segments which are rendered and encoded
+by independent processes, each with its own FFmpeg encoder.
+
+Every segment process opens its own copy of the project and renders a range
+of frames into a video-only Matroska file. Stateful components first render
+the frames before their range (see Component.warmupFrames) so the segments
+join seamlessly. Finally the segments are joined by FFmpeg's concat demuxer
+without re-encoding and the audio of the export is muxed in once.
+
+A resumable export keeps its segments in a work directory along with a
+manifest describing the export. Each segment is renamed into place once it
+is complete, so exporting again after a cancel or crash only renders the
+segments which are missing.
+"""
+
+from collections import namedtuple
+from functools import partial
+import multiprocessing
+import hashlib
+import json
+import math
+import subprocess as sp
+import os
+import sys
+import queue
+import shutil
+import tempfile
+import logging
+
+from .render_pool import startRenderWorker, warmUpComponents
+from .toolkit import formatTraceback
+from .toolkit.frame import FrameBuffers
+from .toolkit.ffmpeg import (
+    FrameWriter,
+    openPipe,
+    createSegmentCommand,
+    createConcatCommand,
+)
+
+
+log = logging.getLogger("AVP.SegmentedExport")
+
+
+Segment = namedtuple("Segment", ["segNo", "startFrame", "endFrame", "path"])
+
+# longest segment of a resumable export (one minute at 30 fps)
+CHECKPOINT_FRAMES = 1800
+
+
+class SegmentedExport:
+    """
+    Exports the video for a video thread Worker which has already determined
+    the length of the audio, using the given number of segment processes.
+    run() blocks until the output file is written or the export fails, and
+    returns whether it succeeded.
+
+    If workDir is given the export is resumable: the segments are kept there
+    until the export succeeds, and complete segments of an earlier export of
+    the same project and audio are reused.
+    """
+
+    def __init__(self, worker, processes, duration, workDir=None):
+        self.worker = worker
+        self.duration = duration
+        self.frameCount = len(range(0, worker.audioArrayLen, worker.sampleSize))
+        # frames before this are the pre-roll of a partial export
+        self.firstFrameNo = worker.firstFrameNo
+        # the serial export's FFmpeg reads duration + 0.1 seconds of frames, and
+        # the segments are joined without re-encoding, so none can be cut off
+        frameRate = int(worker.settings.value("outputFrameRate"))
+        self.exportFrames = exportFrames = min(
+            self.frameCount - self.firstFrameNo,
+            math.ceil(round((duration + 0.1) * frameRate, 3)),
+        )
+        self.resumable = workDir is not None
+        if self.resumable:
+            os.makedirs(workDir, exist_ok=True)
+            self.workDir = workDir
+            segments = max(processes, -(-exportFrames // CHECKPOINT_FRAMES))
+        else:
+            self.workDir = tempfile.mkdtemp(prefix="avp-segments-")
+            segments = processes
+        segments = max(1, min(segments, exportFrames))
+        self.segments = [
+            Segment(
+                segNo,
+                self.firstFrameNo + exportFrames * segNo // segments,
+                self.firstFrameNo + exportFrames * (segNo + 1) // segments,
+                os.path.join(self.workDir, "segment%s.mkv" % segNo),
+            )
+            for segNo in range(segments)
+        ]
+        self.processCount = min(processes, segments)
+        self.processes = []
+        # segments which were completed by an earlier export
+        self.completeSegments = []
+        self.error = None
+        self.succeeded = False
+        self.logLevel = "info" if log.getEffectiveLevel() < logging.WARNING else "error"
+
+    def run(self):
+        try:
+            # Segment processes read the project from disk and share settings.ini
+            projectPath = os.path.join(self.workDir, "render.avp")
+            self.worker.core.createProjectFile(projectPath)
+            self.worker.settings.sync()
+            if self.resumable:
+                self.loadManifest(projectPath)
+            if not self.renderSegments(projectPath):
+                return False
+            self.succeeded = self.concatSegments()
+            return self.succeeded
+        finally:
+            self.close()
+
+    def createManifest(self, projectPath):
+        """
+        Describes everything the segments depend on: the components of the
+        project, the settings used to encode them, the audio and the frames
+        """
+        projectHash = hashlib.sha256()
+        with open(projectPath, "rb") as f:
+            # the [Settings] section only holds the last directories used
+            for line in f:
+                if line.strip() == b"[Settings]":
+                    break
+                projectHash.update(line)
+        # the encoding settings, without the path of the segment
+        projectHash.update(" ".join(createSegmentCommand("")[1:]).encode())
+        with open(self.worker.inputFile, "rb") as f:
+            audioHash = hashlib.file_digest(f, "sha256").hexdigest()
+        return {
+            "projectHash": projectHash.hexdigest(),
+            "audioHash": audioHash,
+            "timeRange": [self.worker.startTime, self.worker.endTime],
+            "frameRange": [self.firstFrameNo, self.frameCount],
+            "segments": [
+                [segment.startFrame, segment.endFrame] for segment in self.segments
+            ],
+        }
+
+    def loadManifest(self, projectPath):
+        """
+        Finds the segments completed by an earlier export with the same
+        manifest, or removes them if the manifest is different
+        """
+        manifest = self.createManifest(projectPath)
+        manifestPath = os.path.join(self.workDir, "manifest.json")
+        try:
+            with open(manifestPath) as f:
+                oldManifest = json.load(f)
+        except (OSError, ValueError):
+            oldManifest = None
+
+        if oldManifest == manifest:
+            self.completeSegments = [
+                segment for segment in self.segments if os.path.exists(segment.path)
+            ]
+            log.info(
+                "Resuming export with %s of %s segments complete",
+                len(self.completeSegments),
+                len(self.segments),
+            )
+            return
+
+        if oldManifest is not None:
+            log.info("Project or audio has changed, discarding old segments")
+        for filename in os.listdir(self.workDir):
+            if filename.startswith("segment"):
+                os.remove(os.path.join(self.workDir, filename))
+        with open(manifestPath + ".part", "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(manifestPath + ".part", manifestPath)
+
+    def renderSegments(self, projectPath):
+        worker = self.worker
+        missingSegments = [
+            segment
+            for segment in self.segments
+            if segment not in self.completeSegments
+        ]
+        processCount = min(self.processCount, len(missingSegments))
+        context = multiprocessing.get_context("spawn")
+        self.errors = context.Queue()
+        # number of frames finished by each segment process
+        progress = context.Array("i", processCount, lock=False)
+        for procNo in range(processCount):
+            process = context.Process(
+                target=segmentProcess,
+                name="AVP Segment Process #%s" % procNo,
+                args=(
+                    procNo,
+                    missingSegments[procNo::processCount],
+                    projectPath,
+                    type(worker.core).dataDir,
+                    worker.inputFile,
+                    (worker.startTime, worker.endTime),
+                    self.logLevel,
+                    progress,
+                    self.errors,
+                ),
+            )
+            process.daemon = True
+            self.processes.append(process)
+
+        log.info(
+            "Starting %s segment processes for %s of %s segments",
+            len(self.processes),
+            len(missingSegments),
+            len(self.segments),
+        )
+        for process in self.processes:
+            process.start()
+
+        completeFrames = sum(
+            segment.endFrame - segment.startFrame for segment in self.completeSegments
+        )
+        progressBarValue = 0
+        while any(process.is_alive() for process in self.processes):
+            if worker.canceled or self.checkErrors():
+                return False
+            for process in self.processes:
+                process.join(timeout=0.25 / len(self.processes))
+            completion = (completeFrames + sum(progress)) / self.exportFrames * 100
+            if progressBarValue + 1 <= completion:
+                progressBarValue = int(completion)
+                worker.progressBarUpdate.emit(progressBarValue)
+                worker.progressBarSetText.emit(
+                    "Exporting video: %s%%" % progressBarValue
+                )
+
+        if worker.canceled or self.checkErrors():
+            return False
+        for procNo, process in enumerate(self.processes):
+            if process.exitcode != 0:
+                self.error = (
+                    "Segment process #%s exited unexpectedly." % procNo,
+                    "Exit code: %s" % process.exitcode,
+                )
+                return False
+        return True
+
+    def concatSegments(self):
+        worker = self.worker
+        worker.progressBarSetText.emit("Joining segments...")
+        listFile = os.path.join(self.workDir, "segments.txt")
+        with open(listFile, "w") as f:
+            for segment in self.segments:
+                f.write("file '%s'\n" % segment.path.replace("'", "'\\''"))
+
+        ffmpegCommand = createConcatCommand(
+            listFile,
+            worker.inputFile,
+            worker.outputFile,
+            worker.components,
+            self.duration,
+            self.logLevel,
+            startTime=worker.startTime,
+        )
+        if not ffmpegCommand:
+            self.error = ("The FFmpeg command could not be generated.", "")
+            return False
+        log.info(" ".join(ffmpegCommand))
+        # kept by the worker so cancel() can terminate it
+        worker.out_pipe = openPipe(ffmpegCommand, stdout=sys.stdout, stderr=sys.stdout)
+        returnCode = worker.out_pipe.wait()
+        worker.out_pipe = None
+        if returnCode != 0 and not worker.canceled:
+            self.error = (
+                "FFmpeg could not join the segments.",
+                "Exit code: %s" % returnCode,
+            )
+            return False
+        return not worker.canceled
+
+    def checkErrors(self):
+        try:
+            self.error = self.errors.get_nowait()
+        except queue.Empty:
+            return False
+        log.error("Segmented export failed: %s", self.error[0])
+        return True
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        if self.processes:
+            self.errors.close()
+        if self.succeeded or not self.resumable:
+            shutil.rmtree(self.workDir, ignore_errors=True)
+        log.info("Segmented export closed")
+
+
+def segmentProcess(
+    procNo,
+    segments,
+    projectPath,
+    dataDir,
+    inputFile,
+    timeRange,
+    logLevel,
+    progress,
+    errors,
+):
+    """
+    Entry point of each segment process created by SegmentedExport.
+    Renders and encodes each of the segments in order
+    """
+    name = "Segment process #%s" % procNo
+    outPipe = None
+    worker = None
+    try:
+        worker = startRenderWorker(
+            name,
+            projectPath,
+            dataDir,
+            inputFile,
+            timeRange,
+            max(segment.endFrame for segment in segments),
+            errors,
+        )
+        if worker is None:
+            return
+
+        queueDepth = int(worker.settings.value("pref_writerQueueDepth"))
+        frameBuffers = FrameBuffers(worker.width, worker.height, queueDepth + 2)
+        lastFrameNo = -1
+        for segment in segments:
+            warmUpComponents(worker.components, segment.startFrame, lastFrameNo)
+            # an incomplete segment never has the name of a complete one
+            partPath = segment.path + ".part"
+            outPipe = openPipe(
+                createSegmentCommand(partPath, logLevel),
+                stdin=sp.PIPE,
+                stdout=sys.stdout,
+                stderr=sys.stdout,
+                bufsize=0,
+            )
+            frameWriter = FrameWriter(outPipe, queueDepth)
+            for frameNo in range(segment.startFrame, segment.endFrame):
+                frameData = frameBuffers.get()
+                worker.frameRender(frameNo * worker.sampleSize, frameData)
+                if worker.error:
+                    return
+                if not frameWriter.write(
+                    frameData, partial(frameBuffers.release, frameData)
+                ):
+                    break
+                progress[procNo] += 1
+            frameWriter.close()
+            outPipe.stdin.close()
+            if outPipe.wait() != 0 or frameWriter.error is not None:
+                errors.put(
+                    (
+                        "FFmpeg could not encode segment #%s." % segment.segNo,
+                        "Exit code: %s" % outPipe.returncode,
+                    )
+                )
+                return
+            os.replace(partPath, segment.path)
+            lastFrameNo = segment.endFrame - 1
+
+        worker.postFrameRender()
+    except Exception as e:
+        errors.put(
+            (
+                "%s encountered %s: %s" % (name, e.__class__.__name__, str(e)),
+                formatTraceback(),
+            )
+        )
+    finally:
+        if worker is not None:
+            # removes analyses this process didn't finish from the cache
+            worker.closeSpectrumCache()
+        if outPipe is not None and outPipe.poll() is None:
+            outPipe.kill()
@@ -0,0 +1,189 @@
+"""
+Persistent cache of decoded audio and spectrum analyses, so that exporting
+the same audio again doesn't decode or analyze it again
+"""
+
+import numpy
+import hashlib
+import json
+import os
+import time
+import logging
+
+from .common import fileIdentity
+
+
+log = logging.getLogger("AVP.Toolkit.Cache")
+
+
+# incomplete files older than this (in seconds) were left by a crash
+STALE_PART_AGE = 86400
+
+# content hashes of audio files by (path, size, modification time)
+fileHashes = {}
+
+
+def hashFile(filename):
+    """Returns the sha256 of the contents of a file, hashing it once per process"""
+    fileId = fileIdentity(filename)
+    if fileId not in fileHashes:
+        with open(filename, "rb") as f:
+            fileHashes[fileId] = hashlib.file_digest(f, "sha256").hexdigest()
+    return fileHashes[fileId]
+
+
+class AnalysisCache:
+    """
+    Arrays saved as memory-mapped .npy files in cacheDir, named by a hash of
+    everything they depend on. Files used least recently are removed once
+    the cache is bigger than sizeLimit bytes.
+
+    An array is written to a .part file and renamed into place once it is
+    complete, so other processes (e.g., render processes) never load an
+    incomplete array and may save the same array at the same time.
+    """
+
+    def __init__(self, cacheDir, sizeLimit):
+        self.cacheDir = cacheDir
+        self.sizeLimit = sizeLimit
+        os.makedirs(cacheDir, exist_ok=True)
+
+    def audioKey(self, filename, startTime, duration):
+        """Identifies the audio read by readAudioFile with these arguments"""
+        return self.hashKey(
+            {
+                "audioHash": hashFile(filename),
+                "startTime": startTime,
+                "duration": duration,
+                # the format readAudioFile decodes to
+                "sampleRate": 44100,
+                "channels": 1,
+            }
+        )
+
+    def spectrumKey(self, audioKey, sampleSize, down, up, scale, bins, dtype):
+        """Identifies the spectrum analysis of the audio with these parameters"""
+        return self.hashKey(
+            {
+                "audioKey": audioKey,
+                "sampleSize": sampleSize,
+                "smoothConstantDown": down,
+                "smoothConstantUp": up,
+                "scale": scale,
+                "bins": None if bins is None else list(bins),
+                "dtype": dtype,
+            }
+        )
+
+    @staticmethod
+    def hashKey(params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def path(self, kind, key, extension=".npy"):
+        return os.path.join(self.cacheDir, "%s-%s%s" % (kind, key[:32], extension))
+
+    def loadAudio(self, key):
+        """Returns (completeAudioArray, duration) like readAudioFile, or None"""
+        completeAudioArray = self.loadArray(self.path("audio", key))
+        if completeAudioArray is None:
+            return None
+        try:
+            with open(self.path("audio", key, ".json")) as f:
+                duration = json.load(f)["duration"]
+        except (OSError, ValueError, KeyError):
+            return None
+        self.touch(self.path("audio", key, ".json"))
+        log.info("Loaded the decoded audio from the cache")
+        return completeAudioArray, duration
+
+    def saveAudio(self, key, completeAudioArray, duration):
+        jsonPath = self.path("audio", key, ".json")
+        with open(self.partPath(jsonPath), "w") as f:
+            json.dump({"duration": duration}, f)
+        os.replace(self.partPath(jsonPath), jsonPath)
+        self.saveArray(self.path("audio", key), completeAudioArray)
+
+    def loadSpectrum(self, key):
+        """Returns the spectra of a SpectrumArray, or None"""
+        spectra = self.loadArray(self.path("spectrum", key))
+        if spectra is not None:
+            log.info("Loaded a spectrum analysis from the cache")
+        return spectra
+
+    def saveSpectrum(self, key, spectra):
+        self.saveArray(self.path("spectrum", key), spectra)
+
+    def createSpectrum(self, key, shape, dtype):
+        """
+        Returns a memory-mapped array to be filled with the spectra of a
+        StreamingSpectrumArray, then given to saveSpectrum
+        """
+        return numpy.lib.format.open_memmap(
+            self.partPath(self.path("spectrum", key)), "w+", dtype, shape
+        )
+
+    def discardSpectrum(self, spectra):
+        """
+        Removes the file of an incomplete array from createSpectrum. If it
+        is still mapped on Windows, prune removes it once it is stale
+        """
+        self.remove(spectra.filename)
+
+    def loadArray(self, path):
+        try:
+            array = numpy.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        self.touch(path)
+        return array
+
+    def saveArray(self, path, array):
+        if isinstance(array, numpy.memmap) and array.filename is not None:
+            # already written to a .part file by createSpectrum
+            array.flush()
+            os.replace(array.filename, path)
+        else:
+            with open(self.partPath(path), "wb") as f:
+                numpy.save(f, array)
+            os.replace(self.partPath(path), path)
+        self.prune()
+
+    @staticmethod
+    def partPath(path):
+        return "%s.%s.part" % (path, os.getpid())
+
+    @staticmethod
+    def touch(path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """Removes the least recently used files until the cache fits sizeLimit"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.cacheDir):
+            stat = entry.stat()
+            if entry.name.endswith(".part"):
+                # written by an export which was canceled or crashed
+                if now - stat.st_mtime > STALE_PART_AGE:
+                    self.remove(entry.path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(fileSize for _, fileSize, _ in files)
+        for _, fileSize, path in sorted(files):
+            if size <= self.sizeLimit:
+                break
+            if self.remove(path):
+                size -= fileSize
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # e.g., memory-mapped by another process on Windows
+            return False
+        log.info("Removed %s from the cache", os.path.basename(path))
+        return True
@@ -6,6 +6,7 @@ from PyQt6 import QtWidgets
 import string
 import random
 import sys
+import os
 import subprocess
 import logging
 from copy import copy
@@ -105,6 +106,15 @@ def checkOutput(commandList, **kwargs):
     return subprocess.check_output(commandList, **kwargs)
 
 
+def fileIdentity(filename):
+    """
+    Identifies the contents of a file by its path, size and modification time,
+    so anything derived from them can be reused until the file changes
+    """
+    stat = os.stat(filename)
+    return (os.path.realpath(filename), stat.st_size, stat.st_mtime_ns)
+
+
 def disableWhenEncoding(func):
     def decorator(self, *args, **kwargs):
         if self.encoding:
@@ -0,0 +1,90 @@
+"""
+Stacks the frames returned by each component into the final frame of a video
+"""
+
+from PIL import Image
+import logging
+
+from .frame import BlankFrame, PaddedFrame, copyFrameInto
+
+
+log = logging.getLogger("AVP.Toolkit.Compositor")
+
+
+class Layer:
+    """
+    A Pillow image which is added to a Compositor many times (e.g., the frame
+    of a static component), so whether it can be skipped is only checked once
+    and only the bounding box of its visible pixels is kept
+    """
+
+    def __init__(self, image):
+        box = image.getbbox(alpha_only=True)
+        self.transparent = box is None
+        self.opaque = False
+        if self.transparent:
+            return
+        if box == (0, 0) + image.size:
+            self.opaque = image.getchannel("A").getextrema()[0] == 255
+            self.image = image
+        else:
+            self.image = image.crop(box)
+        self.offset = box[:2]
+
+
+class Compositor:
+    """
+    Blends RGBA layers from the bottom up with Pillow's alpha_composite.
+    A fully transparent Layer is skipped and an opaque Layer replaces
+    everything beneath it, without blending any pixels. A layer smaller
+    than the frame is only blended within its own rectangle.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.clear()
+
+    def clear(self):
+        self.frame = None
+        # whether self.frame was created here and can be changed in place
+        self.ownFrame = False
+
+    def addLayer(self, layer, offset=(0, 0)):
+        """
+        Blends a Pillow image or a Layer on top of everything added so far.
+        An image smaller than the frame is placed at offset (x, y)
+        """
+        if isinstance(layer, Layer):
+            if layer.transparent:
+                return
+            if layer.opaque:
+                self.frame = layer.image
+                self.ownFrame = False
+                return
+            layer, offset = layer.image, layer.offset
+
+        if self.frame is None:
+            self.frame = PaddedFrame(layer, offset, self.width, self.height)
+            self.ownFrame = self.frame is not layer
+        elif offset == (0, 0) and layer.size == (self.width, self.height):
+            self.frame = Image.alpha_composite(self.frame, layer)
+            self.ownFrame = True
+        else:
+            if not self.ownFrame:
+                self.frame = self.frame.copy()
+                self.ownFrame = True
+            self.frame.alpha_composite(layer, offset)
+
+    def writeInto(self, frameData):
+        """Writes the finished frame into a uint8 RGBA array of the same size"""
+        if self.frame is None:
+            frameData.fill(0)
+        else:
+            copyFrameInto(self.frame, frameData)
+
+    def toImage(self):
+        """Returns the finished frame as an RGBA Pillow image"""
+        if self.frame is None:
+            return BlankFrame(self.width, self.height)
+        return self.frame
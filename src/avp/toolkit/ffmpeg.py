@@ -8,21 +8,39 @@ import os
 import subprocess
 import threading
 import signal
-from queue import PriorityQueue
+import shutil
+import json
+import re
+import contextlib
+from collections import namedtuple
+from queue import Queue
 import logging
 
 from ..core import Core
-from .common import checkOutput, pipeWrapper
+from .common import checkOutput, pipeWrapper, fileIdentity
 
 
 log = logging.getLogger("AVP.Toolkit.Ffmpeg")
 
+# shortest part of the audio decoded by each process of readAudioSegments
+MIN_DECODE_SEGMENT = 60
+# seconds of audio decoded and dropped before each of those parts
+DECODE_PREROLL = 1
+
 
 class FfmpegVideo:
     """Opens an input pipe to ffmpeg and stores a buffer of raw video frames."""
 
     # error from the thread used to fill the buffer
     threadError = None
+    # whether the thread should stop
+    closed = False
+    # whether FFmpeg ran out of frames, so the last one is repeated
+    ended = False
+    # DecoderScheduler giving the thread turns to read frames, if any
+    scheduler = None
+    # group of the FrameRing if FFmpeg writes other outputs (see FrameRing)
+    frameRings = None
 
     def __init__(self, **kwargs):
         mandatoryArgs = [
@@ -38,9 +56,8 @@ class FfmpegVideo:
         for arg in mandatoryArgs:
             setattr(self, arg, kwargs[arg])
 
-        self.frameNo = -1
-        self.currentFrame = "None"
         self.map_ = None
+        self.scheduler = kwargs.get("scheduler")
 
         if "loopVideo" in kwargs and kwargs["loopVideo"]:
             self.loopValue = "-1"
@@ -52,21 +69,35 @@ class FfmpegVideo:
         else:
             kwargs["filter_"] = None
 
+        # frame 0 can be from startTime seconds into the input
+        seekOption = createSeekOption(kwargs.get("startTime", 0))
+        # -r numbers the frames of a video input at frameRate, which an input
+        # seek ignores, so a video is seeked by dropping its first frames
+        seekVideo = type(kwargs["filter_"]) is list and any(
+            "[0:v]" in arg for arg in kwargs["filter_"]
+        )
         self.command = [
             Core.FFMPEG_BIN,
             "-thread_queue_size",
             "512",
+            *createThreadOptions(self.scheduler),
             "-r",
             str(self.frameRate),
             "-stream_loop",
             str(self.loopValue),
-            "-i",
-            self.inputPath,
-            "-f",
-            "image2pipe",
-            "-pix_fmt",
-            "rgba",
+            *([] if seekVideo else seekOption),
         ]
+        self.command.extend(
+            [
+                "-i",
+                self.inputPath,
+                *(seekOption if seekVideo else []),
+                "-f",
+                "image2pipe",
+                "-pix_fmt",
+                "rgba",
+            ]
+        )
         if type(kwargs["filter_"]) is list:
             self.command.extend(kwargs["filter_"])
         self.command.extend(
@@ -77,9 +108,14 @@ class FfmpegVideo:
             ]
         )
 
-        self.frameBuffer = PriorityQueue()
-        self.frameBuffer.maxsize = self.frameRate
-        self.finishedFrames = {}
+        self.startThread()
+
+    def startThread(self):
+        self.frames = FrameRing(
+            int(self.component.settings.value("pref_readAheadFrames")),
+            self.chunkSize,
+            self.frameRings,
+        )
 
         self.thread = threading.Thread(
             target=self.fillBuffer, name="FFmpeg Frame-Fetcher"
@@ -88,18 +124,37 @@ class FfmpegVideo:
         self.thread.start()
 
     def frame(self, num):
-        while True:
-            if num in self.finishedFrames:
-                image = self.finishedFrames.pop(num)
-                return image
-
-            i, image = self.frameBuffer.get()
-            self.finishedFrames[i] = image
-            self.frameBuffer.task_done()
-
-    def fillBuffer(self):
-        from ..libcomponent import ComponentError
+        """
+        Returns frame num as a numpy array of its RGBA bytes, which is reused
+        for another frame once a later frame is requested (so must be copied
+        to be kept). Frames are requested in order. It's empty if the thread
+        stopped before reading it, and as nothing is read after that, the last
+        frame returned is never overwritten (so needn't be copied to be used
+        in place of the missing frames)
+        """
+        frame = self.frames.get(num)
+        if frame is None:
+            if FfmpegVideo.threadError is not None:
+                raise FfmpegVideo.threadError
+            return b""
+        return frame
+
+    def close(self):
+        self.closed = True
+        self.frames.close()
+        log.info(
+            "%s waited for FFmpeg's frames %s times and filled its buffer %s times",
+            self.component,
+            self.frames.stalls,
+            self.frames.fullWaits,
+        )
+        closePipe(self.pipe)
 
+    def openOutput(self):
+        """
+        Starts FFmpeg and returns the file its frames are read from, which is
+        unbuffered since they're read straight into the FrameRing
+        """
         if Core.logEnabled:
             logFilename = os.path.join(
                 Core.logDir, "render_%s.log" % str(self.component.compPos)
@@ -113,7 +168,7 @@ class FfmpegVideo:
                     stdin=subprocess.DEVNULL,
                     stdout=subprocess.PIPE,
                     stderr=logf,
-                    bufsize=10**8,
+                    bufsize=0,
                 )
         else:
             self.pipe = openPipe(
@@ -121,41 +176,633 @@ class FfmpegVideo:
                 stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,
-                bufsize=10**8,
+                bufsize=0,
             )
+        return self.pipe.stdout
 
-        while True:
-            if self.parent.canceled:
-                break
-            self.frameNo += 1
+    def fillBuffer(self):
+        from ..libcomponent import ComponentError
 
-            # If we run out of frames, use the last good frame and loop.
-            try:
-                if len(self.currentFrame) == 0:
-                    self.frameBuffer.put((self.frameNo - 1, self.lastFrame))
-                    continue
-            except AttributeError:
-                FfmpegVideo.threadError = ComponentError(
-                    self.component,
-                    "video",
-                    "Video seemed playable but wasn't.",
+        output = self.openOutput()
+        lastFrame = None
+        try:
+            while not (self.parent.canceled or self.closed):
+                frame = self.frames.slot()
+                if frame is None:
+                    break
+                if not self.ended:
+                    try:
+                        with self.decoderTurn():
+                            size = readFrameInto(output, frame)
+                    except (ValueError, OSError):
+                        if not self.closed:
+                            FfmpegVideo.threadError = ComponentError(
+                                self.component, "video"
+                            )
+                        break
+                    if size == len(frame):
+                        lastFrame = frame
+                        self.frames.publish()
+                        continue
+                    if lastFrame is None:
+                        FfmpegVideo.threadError = ComponentError(
+                            self.component,
+                            "video",
+                            "Video seemed playable but wasn't.",
+                        )
+                        break
+                    self.ended = True
+                # If we run out of frames, use the last good frame and loop.
+                frame[:] = lastFrame
+                lastFrame = frame
+                self.frames.publish()
+        finally:
+            # wakes frame() if it's waiting for a frame which won't be read
+            self.frames.close()
+
+    def decoderTurn(self):
+        if self.scheduler is None:
+            return contextlib.nullcontext()
+        return self.scheduler.turn(self.frames)
+
+
+class FrameRing:
+    """
+    A fixed number of preallocated frames which the thread of an FfmpegVideo
+    reads from FFmpeg ahead of the frames requested. The frame of each slot
+    can be overwritten once a later frame is requested, so at most the
+    number of slots are read ahead. How often each side waited for the other
+    is counted: stalls are requests for frames not read yet, and fullWaits
+    are times the thread waited for a slot to read ahead into.
+
+    The rings of the outputs of one FFmpeg process are a group, given as a
+    list. FFmpeg may write the frames of one output well ahead of another's,
+    so a full ring grows instead of waiting while a frame of another ring in
+    its group is requested, as that frame may not be written until then.
+    """
+
+    def __init__(self, slots, chunkSize, group=None):
+        # the last frame read is copied into the next slot at the end
+        self.frames = numpy.empty((max(2, slots), chunkSize), dtype="uint8")
+        self.group = group
+        if group:
+            # woken by the requests for the frames of the group
+            self.condition = group[0].condition
+        else:
+            self.condition = threading.Condition()
+        if group is not None:
+            with self.condition:
+                group.append(self)
+        # frames read into the ring
+        self.written = 0
+        # frames before this can be overwritten
+        self.released = 0
+        # whether a frame not read yet is requested
+        self.requested = False
+        self.closed = False
+        self.stalls = 0
+        self.fullWaits = 0
+
+    @property
+    def buffered(self):
+        """Number of frames read ahead of the last frame requested"""
+        return self.written - self.released
+
+    def slot(self):
+        """
+        Waits until a slot can be overwritten and returns it to read the next
+        frame into, then publish() makes it available. None once closed
+        """
+        with self.condition:
+            if self.buffered >= len(self.frames) and not self.closed:
+                self.fullWaits += 1
+                while self.buffered >= len(self.frames) and not self.closed:
+                    if self.group is not None and any(
+                        ring.requested for ring in self.group if ring is not self
+                    ):
+                        self.resize(2 * len(self.frames))
+                        break
+                    self.condition.wait()
+            if self.closed:
+                return None
+            return self.frames[self.written % len(self.frames)]
+
+    def resize(self, slots):
+        log.debug("Growing a FrameRing to %s frames", slots)
+        frames = numpy.empty((slots, self.frames.shape[1]), dtype="uint8")
+        # the frame last requested may still be in use, so it is kept too
+        for num in range(self.released, self.written):
+            frames[num % slots] = self.frames[num % len(self.frames)]
+        self.frames = frames
+
+    def publish(self):
+        with self.condition:
+            self.written += 1
+            self.condition.notify_all()
+
+    def get(self, num):
+        """Waits until frame num is read and returns it, or None once closed"""
+        with self.condition:
+            # earlier frames won't be requested, so their slots can be reused
+            if num > self.released:
+                self.released = num
+                self.condition.notify_all()
+            if self.written <= num and not self.closed:
+                self.stalls += 1
+                self.requested = True
+                # a full ring of the group may have to grow for this frame
+                self.condition.notify_all()
+                while self.written <= num and not self.closed:
+                    self.condition.wait()
+                self.requested = False
+            if self.written <= num:
+                return None
+            return self.frames[num % len(self.frames)]
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class DecoderScheduler:
+    """
+    Limits how many FFmpeg processes of the FfmpegVideos of an export decode
+    at once, so the layers don't compete with each other, the encoder and
+    the renderer for the cores. The thread of each FfmpegVideo takes a turn
+    to read each frame, and an FFmpeg process whose frames aren't read waits
+    once its pipe is full. A free turn goes to the waiting video with the
+    fewest frames read ahead (then the one which stalled most often), so the
+    frames the export is waiting for are decoded first.
+
+    Each process may use its share of the cores (threads), rather than
+    every core as FFmpeg does by default
+    """
+
+    def __init__(self, decoders):
+        self.decoders = max(1, decoders)
+        self.threads = max(1, os.cpu_count() // self.decoders)
+        self.condition = threading.Condition()
+        # FrameRings of the videos waiting for a turn, and those given one
+        self.waiting = []
+        self.granted = set()
+        self.running = 0
+
+    @contextlib.contextmanager
+    def turn(self, frames):
+        """Waits until the video reading into the FrameRing frames may decode"""
+        with self.condition:
+            self.waiting.append(frames)
+            self.grantTurns()
+            while frames not in self.granted:
+                self.condition.wait()
+            self.granted.remove(frames)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.grantTurns()
+
+    def grantTurns(self):
+        # chosen here for every waiting video at once, so they can't disagree
+        # about which one is the most starved while frames are requested
+        while self.waiting and self.running < self.decoders:
+            frames = min(
+                self.waiting, key=lambda frames: (frames.buffered, -frames.stalls)
+            )
+            self.waiting.remove(frames)
+            self.granted.add(frames)
+            self.running += 1
+            self.condition.notify_all()
+
+
+def createThreadOptions(scheduler):
+    """Options giving an FFmpeg process its share of the cores (if limited)"""
+    if scheduler is None:
+        return []
+    return [
+        "-filter_complex_threads",
+        str(scheduler.threads),
+        # an input option, so it must come before -i
+        "-threads",
+        str(scheduler.threads),
+    ]
+
+
+def readFrameInto(output, frame):
+    """
+    Reads a frame from an unbuffered pipe into a writable buffer, returning
+    the number of bytes read, which is less at the end of the pipe
+    """
+    view = memoryview(frame)
+    size = 0
+    while size < len(view):
+        count = output.readinto(view[size:])
+        if not count:
+            break
+        size += count
+    return size
+
+
+class FfmpegAudioGraph:
+    """
+    One FFmpeg process shared by the layers of an export which make frames
+    from the audio with FFmpeg filters (e.g., Spectrum and Waveform), so the
+    audio is decoded once. It is split by asplit between the filtergraphs
+    of the layers, each writing its frames to its own pipe.
+
+    The frames of the layers are read in step, so only filters which make
+    frames at the export's frame rate can share the process. It starts when
+    the first frame is read, so each layer must be added before then
+    """
+
+    def __init__(self, inputPath, startTime=0, scheduler=None):
+        self.inputPath = inputPath
+        self.startTime = startTime
+        # only limits the threads of the process, since every layer of it
+        # must be read at once (see DecoderScheduler)
+        self.scheduler = scheduler
+        self.videos = []
+        # FrameRings of the layers' frames
+        self.frameRings = []
+        self.process = None
+        self.closed = False
+
+    def video(self, **kwargs):
+        """
+        Adds a layer, given the arguments of FfmpegVideo except inputPath,
+        and returns an object which is read like its FfmpegVideo
+        """
+        if sys.platform == "win32":
+            # pipes can't be passed to FFmpeg as file descriptors
+            return FfmpegVideo(
+                inputPath=self.inputPath, startTime=self.startTime, **kwargs
+            )
+        video = SharedFfmpegVideo(self, **kwargs)
+        self.videos.append(video)
+        return video
+
+    def createCommand(self, writeFds):
+        # the audio input of each layer is one of the outputs of asplit
+        def renameLabels(filterGraph, streamNo):
+            return renameFilterLabels(filterGraph, streamNo, "a%s" % streamNo)
+
+        filterGraphs = [
+            "[0:a] asplit=%s %s"
+            % (
+                len(self.videos),
+                "".join("[a%s]" % streamNo for streamNo in range(len(self.videos))),
+            )
+        ]
+        outputs = []
+        for streamNo, (video, writeFd) in enumerate(zip(self.videos, writeFds)):
+            filter_ = video.filter_
+            filterGraphs.append(
+                renameLabels(filter_[filter_.index("-filter_complex") + 1], streamNo)
+            )
+            outputs.extend(
+                [
+                    "-map",
+                    renameLabels(filter_[filter_.index("-map") + 1], streamNo),
+                    "-f",
+                    "image2pipe",
+                    "-pix_fmt",
+                    "rgba",
+                    "-codec:v",
+                    "rawvideo",
+                    "pipe:%s" % writeFd,
+                ]
+            )
+        return [
+            Core.FFMPEG_BIN,
+            "-thread_queue_size",
+            "512",
+            *createThreadOptions(self.scheduler),
+            "-r",
+            str(self.videos[0].frameRate),
+            "-stream_loop",
+            "0",
+            *createSeekOption(self.startTime),
+            "-i",
+            self.inputPath,
+            "-filter_complex",
+            "; ".join(filterGraphs),
+            *outputs,
+        ]
+
+    def start(self):
+        """Starts FFmpeg and the threads reading each layer's frames"""
+        if self.process is not None:
+            return
+        pipes = [os.pipe() for video in self.videos]
+        writeFds = [writeFd for _, writeFd in pipes]
+        command = self.createCommand(writeFds)
+        log.info(
+            "Creating ffmpeg process shared by %s layers: %s",
+            len(self.videos),
+            " ".join(command),
+        )
+        if Core.logEnabled:
+            logFilename = os.path.join(Core.logDir, "render_audio_graph.log")
+            with open(logFilename, "w") as logf:
+                logf.write(" ".join(command) + "\n\n")
+            with open(logFilename, "a") as logf:
+                self.process = openPipe(
+                    command,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=logf,
+                    pass_fds=writeFds,
                 )
+        else:
+            self.process = openPipe(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                pass_fds=writeFds,
+            )
+        for video, (readFd, writeFd) in zip(self.videos, pipes):
+            # only FFmpeg writes to the pipes, so they end when it does
+            os.close(writeFd)
+            video.readFd = readFd
+            # every layer is read at once, or FFmpeg would wait for one of them
+            video.startThread()
+
+    def close(self):
+        if self.process is None or self.closed:
+            return
+        self.closed = True
+        for video in self.videos:
+            video.closed = True
+            # wake the thread if it is waiting for room in the buffer, so it
+            # stops reading and FFmpeg isn't left waiting to write to its pipe
+            video.frames.close()
+        self.process.terminate()
+
+
+def renameFilterLabels(filterGraph, streamNo, inputLabel):
+    """
+    Renames the link labels of the filtergraph of an FfmpegVideo so it can be
+    part of a larger filtergraph: its input ([0:a] or [0:v]) becomes
+    [inputLabel] and every other label gets the suffix _streamNo
+    """
+    return re.sub(
+        r"\[([^\]]+)\]",
+        lambda label: (
+            "[%s]" % inputLabel
+            if label.group(1) in ("0:a", "0:v")
+            else "[%s_%s]" % (label.group(1), streamNo)
+        ),
+        filterGraph,
+    )
+
+
+class SharedFfmpegVideo(FfmpegVideo):
+    """The frames of one layer of an FfmpegAudioGraph"""
+
+    def __init__(self, graph, **kwargs):
+        self.graph = graph
+        self.frameRings = graph.frameRings
+        for arg in (
+            "filter_",
+            "width",
+            "height",
+            "frameRate",
+            "chunkSize",
+            "parent",
+            "component",
+        ):
+            setattr(self, arg, kwargs[arg])
+
+    def frame(self, num):
+        self.graph.start()
+        return super().frame(num)
+
+    def close(self):
+        self.graph.close()
+
+    def openOutput(self):
+        self.output = open(self.readFd, "rb", buffering=0)
+        return self.output
+
+    def fillBuffer(self):
+        try:
+            super().fillBuffer()
+        finally:
+            self.output.close()
+
+
+# How FFmpeg draws the frames of a component in a native export (see
+# native_export.py). filter_ is like the filter_ of an FfmpegVideo, reading
+# [0:a] from the export's audio, or [0:v] from inputPath (looped if loop is
+# True), and its frames are placed at offset like those of regionRender
+FfmpegLayer = namedtuple(
+    "FfmpegLayer", ["filter_", "offset", "inputPath", "loop"], defaults=[None, False]
+)
+
+
+def escapeFilterValue(value):
+    """Escapes a string (e.g., a path) to be an option value in a filtergraph"""
+    # once for the option and once more for the filtergraph
+    value = re.sub(r"([\\':])", r"\\\1", str(value))
+    return re.sub(r"([\\'\[\],;])", r"\\\1", value)
+
+
+class FrameWriter:
+    """
+    Writes finished frames into the stdin of an FFmpeg process from its own
+    thread, so rendering continues while FFmpeg is busy encoding. At most
+    queueDepth frames wait in the queue; write() blocks when it is full.
+    Frames can be any contiguous buffer and are written without copying
+    if the pipe is unbuffered.
+    """
+
+    def __init__(self, pipe, queueDepth):
+        self.pipe = pipe
+        self.queueDepth = queueDepth
+        self.frameQueue = Queue(maxsize=queueDepth)
+        # most frames that were waiting in the queue at once
+        self.highWaterMark = 0
+        self.error = None
+
+        self.thread = threading.Thread(
+            target=self.drainQueue, name="FFmpeg Frame-Writer"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, frameData, onWritten=None):
+        """
+        Queues a bytes-like frame. onWritten is called from the writer thread
+        once frameData is no longer needed. Returns False if writing failed.
+        """
+        if self.error is not None:
+            if onWritten is not None:
+                onWritten()
+            return False
+        self.frameQueue.put((frameData, onWritten))
+        self.highWaterMark = max(self.highWaterMark, self.frameQueue.qsize())
+        return True
+
+    def drainQueue(self):
+        while True:
+            item = self.frameQueue.get()
+            if item is None:
                 break
+            frameData, onWritten = item
+            if self.error is None:
+                try:
+                    self.writeAll(frameData)
+                except Exception as e:
+                    log.debug("Frame writer stopped: %s", str(e))
+                    self.error = e
+            if onWritten is not None:
+                onWritten()
+
+    def writeAll(self, frameData):
+        # an unbuffered pipe may accept only part of the frame at once
+        with memoryview(frameData).cast("B") as view:
+            written = 0
+            while written < len(view):
+                written += self.pipe.stdin.write(view[written:])
+
+    def close(self):
+        """Waits for every queued frame to be written"""
+        self.frameQueue.put(None)
+        self.thread.join()
+        log.info(
+            "Frame writer queue reached %s of %s frames",
+            self.highWaterMark,
+            self.queueDepth,
+        )
 
-            try:
-                self.currentFrame = self.pipe.stdout.read(self.chunkSize)
-            except ValueError as e:
-                if str(e) == "PyMemoryView_FromBuffer(): info->buf must not be NULL":
-                    log.debug(
-                        "Ignored 'info->buf must not be NULL' error from FFmpeg pipe"
-                    )
-                    return
-                else:
-                    FfmpegVideo.threadError = ComponentError(self.component, "video")
 
-            if len(self.currentFrame) != 0:
-                self.frameBuffer.put((self.frameNo, self.currentFrame))
-                self.lastFrame = self.currentFrame
+class TimestampedFrameWriter(FrameWriter):
+    """
+    A FrameWriter which sends frames to FFmpeg in a Matroska stream, so each
+    frame has a timestamp. A frame identical to the one before it is not sent
+    at all: FFmpeg shows the earlier frame until the next timestamp, and has
+    fewer frames to encode. Frames are compared from the writer thread.
+
+    Every frame from one second before frame number frameCount is sent, as an
+    encoder which reorders frames would otherwise end the video stream up to
+    a few frames before the timestamp of a lone last frame.
+    """
+
+    def __init__(self, pipe, queueDepth, width, height, frameRate, frameCount):
+        self.width = width
+        self.height = height
+        self.frameRate = frameRate
+        self.lastSkippableFrameNo = frameCount - frameRate - 1
+        # number of frames received, sent or not
+        self.frameCount = 0
+        self.skippedFrames = 0
+        # copy of the last frame which was sent
+        self.lastFrame = numpy.empty(width * height * 4, dtype="uint8")
+        super().__init__(pipe, queueDepth)
+
+    def writeAll(self, frameData):
+        frameNo = self.frameCount
+        self.frameCount += 1
+        # no view of frameData is kept, as it may be released once written
+        if (
+            0 < frameNo <= self.lastSkippableFrameNo
+            and numpy.array_equal(
+                numpy.frombuffer(frameData, dtype="uint8"), self.lastFrame
+            )
+        ):
+            self.skippedFrames += 1
+            return
+        if frameNo < self.lastSkippableFrameNo:
+            # kept only while the next frame may be compared with it
+            self.lastFrame[:] = numpy.frombuffer(frameData, dtype="uint8")
+        if frameNo == 0:
+            super().writeAll(
+                createMatroskaHeader(self.width, self.height, self.frameRate)
+            )
+        timestamp = round(frameNo * 1000000000 / self.frameRate)
+        super().writeAll(createMatroskaBlockHeader(timestamp, len(self.lastFrame)))
+        super().writeAll(frameData)
+
+    def close(self):
+        super().close()
+        log.info(
+            "Skipped %s repeated frames of %s", self.skippedFrames, self.frameCount
+        )
+
+
+def ebmlElement(elementId, data):
+    """Encodes an element of a Matroska file, with its size in 8 bytes"""
+    return elementId + ((1 << 56) | len(data)).to_bytes(8, "big") + data
+
+
+def ebmlUInt(elementId, value):
+    return ebmlElement(elementId, value.to_bytes(8, "big"))
+
+
+def createMatroskaHeader(width, height, frameRate):
+    """
+    Start of a Matroska stream with one track of uncompressed RGBA frames,
+    whose timestamps are in nanoseconds. Each frame follows in its own
+    cluster, which begins with createMatroskaBlockHeader
+    """
+    header = ebmlElement(
+        b"\x1a\x45\xdf\xa3",
+        ebmlUInt(b"\x42\x86", 1)  # EBMLVersion
+        + ebmlUInt(b"\x42\xf7", 1)  # EBMLReadVersion
+        + ebmlUInt(b"\x42\xf2", 4)  # EBMLMaxIDLength
+        + ebmlUInt(b"\x42\xf3", 8)  # EBMLMaxSizeLength
+        + ebmlElement(b"\x42\x82", b"matroska")  # DocType
+        + ebmlUInt(b"\x42\x87", 4)  # DocTypeVersion
+        + ebmlUInt(b"\x42\x85", 2),  # DocTypeReadVersion
+    )
+    info = ebmlElement(
+        b"\x15\x49\xa9\x66",
+        ebmlUInt(b"\x2a\xd7\xb1", 1)  # TimestampScale
+        + ebmlElement(b"\x4d\x80", b"avp")  # MuxingApp
+        + ebmlElement(b"\x57\x41", b"avp"),  # WritingApp
+    )
+    video = ebmlElement(
+        b"\xe0",
+        ebmlUInt(b"\xb0", width)  # PixelWidth
+        + ebmlUInt(b"\xba", height)  # PixelHeight
+        + ebmlElement(b"\x2e\xb5\x24", b"RGBA"),  # ColourSpace
+    )
+    tracks = ebmlElement(
+        b"\x16\x54\xae\x6b",
+        ebmlElement(
+            b"\xae",  # TrackEntry
+            ebmlUInt(b"\xd7", 1)  # TrackNumber
+            + ebmlUInt(b"\x73\xc5", 1)  # TrackUID
+            + ebmlUInt(b"\x83", 1)  # TrackType (video)
+            # DefaultDuration, in nanoseconds
+            + ebmlUInt(b"\x23\xe3\x83", round(1000000000 / frameRate))
+            + ebmlElement(b"\x86", b"V_UNCOMPRESSED")  # CodecID
+            + video,
+        ),
+    )
+    # the Segment has an unknown size, as it ends with the stream
+    return header + b"\x18\x53\x80\x67\x01\xff\xff\xff\xff\xff\xff\xff" + info + tracks
+
+
+def createMatroskaBlockHeader(timestamp, frameSize):
+    """Start of a cluster holding one frame of frameSize bytes"""
+    timestampElement = ebmlUInt(b"\xe7", timestamp)
+    # SimpleBlock of track 1, at the cluster's timestamp, as a keyframe
+    blockHeader = (
+        b"\xa3"
+        + ((1 << 56) | (frameSize + 4)).to_bytes(8, "big")
+        + b"\x81\x00\x00\x80"
+    )
+    clusterSize = len(timestampElement) + len(blockHeader) + frameSize
+    return (
+        b"\x1f\x43\xb6\x75"
+        + ((1 << 56) | clusterSize).to_bytes(8, "big")
+        + timestampElement
+        + blockHeader
+    )
 
 
 @pipeWrapper
@@ -168,7 +815,11 @@ def closePipe(pipe):
     pipe.send_signal(signal.SIGTERM)
 
 
-def findFfmpeg():
+def findFfmpeg(cacheFile=None):
+    """
+    Returns the FFmpeg binary, or "" if it doesn't work.
+    Its output is saved in cacheFile (see getFfmpegOutput)
+    """
     if sys.platform == "win32":
         bin = "ffmpeg.exe"
     else:
@@ -178,38 +829,89 @@ def findFfmpeg():
         # The application is frozen
         bin = os.path.join(Core.wd, bin)
 
-    with open(os.devnull, "w") as f:
-        try:
-            checkOutput([bin, "-version"], stderr=f)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            bin = ""
+    try:
+        readFfmpegOutput(bin, cacheFile, "-version")
+    except (subprocess.CalledProcessError, OSError):
+        bin = ""
 
     return bin
 
 
-def createFfmpegCommand(
-    inputFile, outputFile, components, duration=-1, logLevel="info"
-):
+def getFfmpegOutput(*options):
     """
-    Constructs the major ffmpeg command used to export the video
+    Returns the output of Core.FFMPEG_BIN run with options which only depend
+    on the binary, e.g. its version and the encoders it supports. The output
+    is saved in Core.ffmpegCache and only read again when the binary changes
     """
-    if duration == -1:
-        duration = getAudioDuration(inputFile)
-    safeDuration = "{0:.3f}".format(duration - 0.05)  # used by filters
-    duration = "{0:.3f}".format(duration + 0.1)  # used by input sources
+    return readFfmpegOutput(Core.FFMPEG_BIN, Core.ffmpegCache, *options)
 
-    # Test if user has libfdk_aac
-    encoders = checkOutput("%s -encoders -hide_banner" % Core.FFMPEG_BIN, shell=True)
-    encoders = encoders.decode("utf-8")
 
-    acodec = Core.settings.value("outputAudioCodec")
+# output of FFmpeg binaries, by identity of the binary and the options
+ffmpegOutputs = {}
+
+
+def readFfmpegOutput(ffmpegBin, cacheFile, *options):
+    """
+    Returns the stdout of ffmpegBin run with options as a str, or raises
+    like checkOutput. If cacheFile is given it keeps the output of each
+    binary, by path, with the size and modification time of the binary
+    """
+    binPath = shutil.which(ffmpegBin)
+    if binPath is None:
+        raise FileNotFoundError(ffmpegBin)
+    fileId = fileIdentity(binPath)
+    key = " ".join(options)
+    if (fileId, key) in ffmpegOutputs:
+        return ffmpegOutputs[(fileId, key)]
+
+    cache = {}
+    if cacheFile is not None:
+        try:
+            with open(cacheFile) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+    binary = cache.get(fileId[0], {})
+    outputs = binary.get("outputs", {})
+    if [binary.get("size"), binary.get("mtime")] != list(fileId[1:]):
+        outputs = {}
+    if key not in outputs:
+        log.info("Running %s %s", ffmpegBin, key)
+        with open(os.devnull, "w") as f:
+            outputs[key] = checkOutput([ffmpegBin, *options], stderr=f).decode(
+                "utf-8", errors="replace"
+            )
+        if cacheFile is not None:
+            cache[fileId[0]] = {
+                "size": fileId[1],
+                "mtime": fileId[2],
+                "outputs": outputs,
+            }
+            # render processes may save it at the same time
+            partPath = "%s.%s.part" % (cacheFile, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+                with open(partPath, "w") as f:
+                    json.dump(cache, f, indent=4)
+                os.replace(partPath, cacheFile)
+            except OSError as e:
+                log.warning("Couldn't save FFmpeg's capabilities: %s", e)
+    ffmpegOutputs[(fileId, key)] = outputs[key]
+    return outputs[key]
+
+
+def getOutputEncoders():
+    """
+    Returns the video encoder, audio encoder and container format chosen in the
+    settings, or None if FFmpeg doesn't support one of the encoders
+    """
+    # Test if user has libfdk_aac
+    encoders = getFfmpegOutput("-encoders", "-hide_banner")
 
     options = Core.encoderOptions
     containerName = Core.settings.value("outputContainer")
     vcodec = Core.settings.value("outputVideoCodec")
-    vbitrate = str(Core.settings.value("outputVideoBitrate")) + "k"
     acodec = Core.settings.value("outputAudioCodec")
-    abitrate = str(Core.settings.value("outputAudioBitrate")) + "k"
 
     for cont in options["containers"]:
         if cont["name"] == containerName:
@@ -226,7 +928,7 @@ def createFfmpegCommand(
             encoder,
             encoders,
         )
-        return []
+        return None
 
     for encoder in vencoders:
         if encoder in encoders:
@@ -242,14 +944,12 @@ def createFfmpegCommand(
     else:
         return error()
 
-    ffmpegCommand = [
-        Core.FFMPEG_BIN,
-        "-loglevel",
-        logLevel,
-        "-thread_queue_size",
-        "512",
-        "-y",  # overwrite the output file if it already exists.
-        # INPUT VIDEO
+    return vencoder, aencoder, container
+
+
+def createRawVideoInput():
+    """Input options for frames piped into FFmpeg by the video thread"""
+    return [
         "-f",
         "rawvideo",
         "-vcodec",
@@ -260,29 +960,100 @@ def createFfmpegCommand(
         "rgba",
         "-r",
         str(Core.settings.value("outputFrameRate")),
+    ]
+
+
+def createStillImageInput(stillImage, duration):
+    """
+    Input options for a video made of one image file, which FFmpeg loops
+    at one frame per second instead of receiving every frame from a pipe.
+    The image is only decoded once per second, and FFmpeg repeats it to make
+    the output frame rate (see createFfmpegCommand)
+    """
+    return [
+        "-loop",
+        "1",
+        "-framerate",
+        "1",
         "-t",
         duration,
-        "-an",  # the video input has no sound
         "-i",
-        "-",  # the video input comes from a pipe
+        stillImage,
+    ]
+
+
+def createFilterGraphInput(filterGraph, duration):
+    """
+    Input options for a video drawn by an FFmpeg filtergraph with one output,
+    (see native_export.py) instead of receiving every frame from a pipe
+    """
+    return ["-f", "lavfi", "-t", duration, "-i", filterGraph]
+
+
+def createFfmpegCommand(
+    inputFile,
+    outputFile,
+    components,
+    duration=-1,
+    logLevel="info",
+    startTime=0,
+    stillImage=None,
+    timestampedFrames=False,
+    filterGraph=None,
+):
+    """
+    Constructs the major ffmpeg command used to export the video.
+    The audio begins startTime seconds into the inputFile. If stillImage is
+    the path of an image, it is the whole video and nothing is piped in.
+    Likewise if filterGraph is a filtergraph drawing the whole video.
+    If timestampedFrames is True, the frames are piped in by a
+    TimestampedFrameWriter and encoded at a variable frame rate
+    """
+    if duration == -1:
+        duration = getAudioDuration(inputFile)
+    safeDuration = "{0:.3f}".format(duration - 0.05)  # used by filters
+    duration = "{0:.3f}".format(duration + 0.1)  # used by input sources
+
+    outputEncoders = getOutputEncoders()
+    if outputEncoders is None:
+        return []
+    vencoder, aencoder, container = outputEncoders
+
+    if filterGraph is not None:
+        videoInput = createFilterGraphInput(filterGraph, duration)
+    elif stillImage is None:
+        videoInput = [
+            *(["-f", "matroska"] if timestampedFrames else createRawVideoInput()),
+            "-t",
+            duration,
+            "-an",  # the video input has no sound
+            "-i",
+            "-",  # the video input comes from a pipe
+        ]
+    else:
+        videoInput = createStillImageInput(stillImage, duration)
+
+    ffmpegCommand = [
+        Core.FFMPEG_BIN,
+        "-loglevel",
+        logLevel,
+        "-thread_queue_size",
+        "512",
+        "-y",  # overwrite the output file if it already exists.
+        # INPUT VIDEO
+        *videoInput,
         # INPUT SOUND
+        *createSeekOption(startTime),
         "-t",
         duration,
         "-i",
         inputFile,
     ]
 
-    extraAudio = [comp.audio for comp in components if "audio" in comp.properties()]
-    segment = createAudioFilterCommand(extraAudio, safeDuration)
-    ffmpegCommand.extend(segment)
-    # Map audio from the filters or the single audio input, and map video from the pipe
     ffmpegCommand.extend(
-        [
-            "-map",
-            "0:v",
-            "-map",
-            "[a]" if segment else "1:a",
-        ]
+        createMainAudioMapping(
+            inputFile, components, safeDuration, videoInput="0:v", startTime=startTime
+        )
     )
 
     ffmpegCommand.extend(
@@ -293,19 +1064,27 @@ def createFfmpegCommand(
             "-acodec",
             aencoder,
             "-b:v",
-            vbitrate,
+            str(Core.settings.value("outputVideoBitrate")) + "k",
             "-b:a",
-            abitrate,
+            str(Core.settings.value("outputAudioBitrate")) + "k",
             "-pix_fmt",
             Core.settings.value("outputVideoFormat"),
             "-preset",
             Core.settings.value("outputPreset"),
+            # repeated frames aren't piped in and mustn't be put back
+            *(["-fps_mode", "vfr"] if timestampedFrames else []),
+            # the still image is input at one frame per second
+            *(
+                ["-r", str(Core.settings.value("outputFrameRate"))]
+                if stillImage is not None
+                else []
+            ),
             "-f",
             container,
         ]
     )
 
-    if acodec == "aac":
+    if Core.settings.value("outputAudioCodec") == "aac":
         ffmpegCommand.append("-strict")
         ffmpegCommand.append("-2")
 
@@ -313,8 +1092,127 @@ def createFfmpegCommand(
     return ffmpegCommand
 
 
-def createAudioFilterCommand(extraAudio, duration):
-    """Add extra inputs and any needed filters to the main ffmpeg command."""
+def createSeekOption(startTime):
+    """Input option to start reading an input startTime seconds in"""
+    return ["-ss", "{0:.3f}".format(startTime)] if startTime else []
+
+
+def createMainAudioMapping(
+    inputFile, components, safeDuration, videoInput, startTime=0
+):
+    """
+    Adds the extra audio inputs of components and maps the video input with
+    the mixed audio (or the single audio input, which must be input #1)
+    """
+    extraAudio = [comp.audio for comp in components if "audio" in comp.properties()]
+    segment = createAudioFilterCommand(extraAudio, safeDuration, startTime)
+    # Map audio from the filters or the single audio input, and map video from the pipe
+    return segment + [
+        "-map",
+        videoInput,
+        "-map",
+        "[a]" if segment else "1:a",
+    ]
+
+
+def createSegmentCommand(outputFile, logLevel="info"):
+    """
+    Constructs an ffmpeg command which encodes piped frames into a video-only
+    segment, to be joined with the others by createConcatCommand
+    """
+    outputEncoders = getOutputEncoders()
+    if outputEncoders is None:
+        return []
+    vencoder = outputEncoders[0]
+    return [
+        Core.FFMPEG_BIN,
+        "-loglevel",
+        logLevel,
+        "-y",
+        *createRawVideoInput(),
+        "-i",
+        "-",
+        "-an",
+        "-vcodec",
+        vencoder,
+        "-b:v",
+        str(Core.settings.value("outputVideoBitrate")) + "k",
+        "-pix_fmt",
+        Core.settings.value("outputVideoFormat"),
+        "-preset",
+        Core.settings.value("outputPreset"),
+        # Matroska can hold any of our video codecs
+        "-f",
+        "matroska",
+        outputFile,
+    ]
+
+
+def createConcatCommand(
+    listFile, inputFile, outputFile, components, duration, logLevel="info", startTime=0
+):
+    """
+    Constructs an ffmpeg command which joins the segments named in listFile
+    without re-encoding them, and adds the audio of the export
+    (which begins startTime seconds into the inputFile)
+    """
+    safeDuration = "{0:.3f}".format(duration - 0.05)
+    duration = "{0:.3f}".format(duration + 0.1)
+
+    outputEncoders = getOutputEncoders()
+    if outputEncoders is None:
+        return []
+    aencoder, container = outputEncoders[1:]
+
+    ffmpegCommand = [
+        Core.FFMPEG_BIN,
+        "-loglevel",
+        logLevel,
+        "-y",
+        "-t",
+        duration,
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        listFile,
+        *createSeekOption(startTime),
+        "-t",
+        duration,
+        "-i",
+        inputFile,
+    ]
+    ffmpegCommand.extend(
+        createMainAudioMapping(
+            inputFile, components, safeDuration, videoInput="0:v", startTime=startTime
+        )
+    )
+    ffmpegCommand.extend(
+        [
+            "-vcodec",
+            "copy",
+            "-acodec",
+            aencoder,
+            "-b:a",
+            str(Core.settings.value("outputAudioBitrate")) + "k",
+            "-f",
+            container,
+        ]
+    )
+    if Core.settings.value("outputAudioCodec") == "aac":
+        ffmpegCommand.append("-strict")
+        ffmpegCommand.append("-2")
+    ffmpegCommand.append(outputFile)
+    return ffmpegCommand
+
+
+def createAudioFilterCommand(extraAudio, duration, startTime=0):
+    """
+    Add extra inputs and any needed filters to the main ffmpeg command.
+    In a partial export (startTime > 0) the extra audio is trimmed after
+    its own filters, so e.g. a delayed sound stays in the same place
+    """
     # NOTE: Global filters are currently hard-coded here for debugging use
     globalFilters = 0  # increase to add global filters
 
@@ -324,12 +1222,19 @@ def createAudioFilterCommand(extraAudio, duration):
     ffmpegCommand = []
     # Add -i options for extra input files
     extraFilters = {}
+    inputDuration = duration
+    if startTime:
+        inputDuration = "{0:.3f}".format(float(duration) + startTime)
     for streamNo, params in enumerate(reversed(extraAudio)):
         extraInputFile, params = params
+        if startTime:
+            params = dict(params)
+            params["atrim"] = "=start={0:.3f}".format(startTime)
+            params["asetpts"] = "=PTS-STARTPTS"
         ffmpegCommand.extend(
             [
                 "-t",
-                duration,
+                inputDuration,
                 # Tell ffmpeg about shorter clips (seemingly not needed)
                 #   streamDuration = getAudioDuration(extraInputFile)
                 #   if streamDuration and streamDuration > float(safeDuration)
@@ -415,28 +1320,35 @@ def createAudioFilterCommand(extraAudio, duration):
     return ffmpegCommand
 
 
-def testAudioStream(filename):
-    """Test if an audio stream definitely exists"""
-    audioTestCommand = [
-        Core.FFMPEG_BIN,
-        "-i",
-        filename,
-        "-vn",
-        "-f",
-        "null",
-        "-",
-    ]
+MediaInfo = namedtuple("MediaInfo", ["duration", "streams"])
+MediaStream = namedtuple("MediaStream", ["type", "codec", "sampleRate"])
+
+# e.g. "  Duration: 00:00:03.95, start: 0.000000, bitrate: 60 kb/s"
+DURATION_PATTERN = re.compile(r"^\s*Duration: (\d+):(\d+):([\d.]+)")
+# e.g. "  Stream #0:0(eng): Audio: vorbis, 44100 Hz, stereo, fltp, 64 kb/s"
+STREAM_PATTERN = re.compile(r"^\s*Stream #\d+:\d+.*?: (\w+): (\w+)(?:.*?(\d+) Hz)?")
+
+# MediaInfo of files by (path, size, modification time)
+mediaProbes = {}
+
+
+def probeMedia(filename):
+    """
+    Returns the MediaInfo of a file: its duration in seconds (or False if
+    unknown) and its streams. The file is probed by FFmpeg once, until it
+    changes, rather than each time its duration or streams are needed
+    """
     try:
-        checkOutput(audioTestCommand, stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
-        return False
-    else:
-        return True
+        fileId = fileIdentity(filename)
+    except OSError:
+        return MediaInfo(False, [])
+    if fileId not in mediaProbes:
+        mediaProbes[fileId] = readMediaInfo(filename)
+    return mediaProbes[fileId]
 
 
-def getAudioDuration(filename):
-    """Try to get duration of audio file as float, or False if not possible"""
-    command = [Core.FFMPEG_BIN, "-i", filename]
+def readMediaInfo(filename):
+    command = [Core.FFMPEG_BIN, "-hide_banner", "-i", filename]
 
     try:
         fileInfo = checkOutput(command, stderr=subprocess.STDOUT)
@@ -444,39 +1356,90 @@ def getAudioDuration(filename):
         fileInfo = ex.output
     except (FileNotFoundError, PermissionError):
         # ffmpeg is possibly not installed
-        return False
+        return MediaInfo(False, [])
 
     try:
         info = fileInfo.decode("utf-8").split("\n")
     except UnicodeDecodeError as e:
-        log.error("Unicode error:", str(e))
-        return False
+        log.error("Unicode error: %s", str(e))
+        return MediaInfo(False, [])
 
+    duration = False
+    streams = []
     for line in info:
-        if "Duration" in line:
-            d = line.split(",")[0]
-            d = d.split(" ")[3]
-            d = d.split(":")
-            duration = float(d[0]) * 3600 + float(d[1]) * 60 + float(d[2])
-            break
-    else:
-        # String not found in output
-        return False
-    return duration
+        match = DURATION_PATTERN.match(line)
+        # the first duration is the file's, and it may be "N/A"
+        if match and duration is False:
+            hours, minutes, seconds = match.groups()
+            duration = float(hours) * 3600 + float(minutes) * 60 + float(seconds)
+        match = STREAM_PATTERN.match(line)
+        if match:
+            streamType, codec, sampleRate = match.groups()
+            streams.append(
+                MediaStream(
+                    streamType.lower(),
+                    codec,
+                    None if sampleRate is None else int(sampleRate),
+                )
+            )
+    return MediaInfo(duration, streams)
+
+
+# whether the audio of files by (path, size, modification time) can be decoded
+audioDecodeTests = {}
 
 
-def readAudioFile(filename, videoWorker):
+def testAudioStream(filename):
     """
-    Creates the completeAudioArray given to components
-    and used to draw the classic visualizer.
+    Test if an audio stream definitely exists, and can be decoded. Only the
+    first second of it is decoded, once until the file changes, rather than
+    the whole track (which may be as long as a film)
     """
-    duration = getAudioDuration(filename)
-    if not duration:
-        log.error(f"Audio file {filename} doesn't exist or unreadable.")
-        return
+    if not any(
+        stream.type == "audio" and stream.codec != "none"
+        for stream in probeMedia(filename).streams
+    ):
+        return False
+    try:
+        fileId = fileIdentity(filename)
+    except OSError:
+        return False
+    if fileId not in audioDecodeTests:
+        audioTestCommand = [
+            Core.FFMPEG_BIN,
+            "-i",
+            filename,
+            "-map",
+            "0:a:0",
+            "-t",
+            "1",
+            "-f",
+            "null",
+            "-",
+        ]
+        try:
+            checkOutput(audioTestCommand, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            audioDecodeTests[fileId] = False
+        else:
+            audioDecodeTests[fileId] = True
+    return audioDecodeTests[fileId]
+
+
+def getAudioDuration(filename):
+    """Try to get duration of audio file as float, or False if not possible"""
+    return probeMedia(filename).duration
+
 
-    command = [
+def createDecodeCommand(filename, startTime=0, duration=None):
+    """
+    Decodes the audio of filename from startTime (for duration seconds, or
+    to the end) to stdout in the format of completeAudioArray
+    """
+    return [
         Core.FFMPEG_BIN,
+        *createSeekOption(startTime),
+        *([] if duration is None else ["-t", "{0:.3f}".format(duration)]),
         "-i",
         filename,
         "-f",
@@ -489,32 +1452,63 @@ def readAudioFile(filename, videoWorker):
         "1",  # mono (set to '2' for stereo)
         "-",
     ]
+
+
+def readAudioFile(filename, videoWorker, startTime=0, duration=None, jobs=1):
+    """
+    Creates the completeAudioArray given to components
+    and used to draw the classic visualizer.
+    Only the duration seconds from startTime are read if duration is given.
+    Long audio is decoded in up to jobs parts at once (see readAudioSegments)
+    """
+    window = duration
+    if duration is None:
+        duration = getAudioDuration(filename)
+        if not duration:
+            log.error(f"Audio file {filename} doesn't exist or unreadable.")
+            return
+        duration -= startTime
+
+    segments = min(jobs, int(duration // MIN_DECODE_SEGMENT))
+    if segments > 1:
+        completeAudioArray = readAudioSegments(
+            filename, videoWorker, startTime, duration, window, segments
+        )
+        if completeAudioArray is not None:
+            return (completeAudioArray, duration)
+        if Core.canceled:
+            return
+
     in_pipe = openPipe(
-        command,
+        createDecodeCommand(filename, startTime, window),
         stdout=subprocess.PIPE,
         stderr=subprocess.DEVNULL,
-        bufsize=10**8,
+        # the audio is read straight into completeAudioArray
+        bufsize=0,
     )
 
-    completeAudioArray = numpy.empty(0, dtype="int16")
-
-    progress = 0
+    # room for the expected audio and one second of 0s at the end, which
+    # grows geometrically if the audio turns out to be longer
+    completeAudioArray = numpy.zeros(int(duration * 44100) + 88200, dtype="int16")
+    bytesRead = 0
     lastPercent = None
     while True:
         if Core.canceled:
+            in_pipe.kill()
+            in_pipe.wait()
             return
-        # read 2 seconds of audio
-        progress += 4
-        raw_audio = in_pipe.stdout.read(88200 * 4)
-        if len(raw_audio) == 0:
+        # the last 88200 bytes are left for the 0s at the end
+        if len(completeAudioArray) * 2 - 88200 - bytesRead < 88200:
+            grownArray = numpy.zeros(len(completeAudioArray) * 2, dtype="int16")
+            grownArray[: len(completeAudioArray)] = completeAudioArray
+            completeAudioArray = grownArray
+        buffer = completeAudioArray.view("uint8")
+        chunkSize = in_pipe.stdout.readinto(buffer[bytesRead : len(buffer) - 88200])
+        if not chunkSize:
             break
-        audio_array = numpy.frombuffer(raw_audio, dtype="int16")
-        completeAudioArray = numpy.append(completeAudioArray, audio_array)
-
-        percent = int(100 * (progress / duration))
-        if percent >= 100:
-            percent = 100
+        bytesRead += chunkSize
 
+        percent = min(100, int(100 * bytesRead / (duration * 88200)))
         if lastPercent != percent:
             string = "Loading audio file: " + str(percent) + "%"
             videoWorker.progressBarSetText.emit(string)
@@ -525,14 +1519,129 @@ def readAudioFile(filename, videoWorker):
     in_pipe.kill()
     in_pipe.wait()
 
-    # add 0s the end
-    completeAudioArrayCopy = numpy.zeros(len(completeAudioArray) + 44100, dtype="int16")
-    completeAudioArrayCopy[: len(completeAudioArray)] = completeAudioArray
-    completeAudioArray = completeAudioArrayCopy
+    # the samples read and the 0s at the end
+    completeAudioArray = completeAudioArray[: bytesRead // 2 + 44100]
 
     return (completeAudioArray, duration)
 
 
+def readAudioSegments(filename, videoWorker, startTime, duration, window, segments):
+    """
+    Decodes the audio like readAudioFile, split into segments starting on
+    whole seconds which are decoded at once by their own FFmpeg process and
+    read straight into their part of completeAudioArray. Each process seeks
+    DECODE_PREROLL seconds before its segment and drops the audio before
+    it, so the decoder has settled and the segments join up exactly.
+    Returns completeAudioArray, or None if the segments didn't join up
+    (e.g., the audio is longer than its probed duration) or were canceled
+    """
+    # the second each segment starts, and the end of the audio
+    segmentStarts = [int(duration * segNo / segments) for segNo in range(segments)]
+    segmentEnds = segmentStarts[1:] + [None]
+    # room for the expected audio and one second of 0s at the end
+    completeAudioArray = numpy.zeros(int(duration * 44100) + 88200, dtype="int16")
+    buffer = completeAudioArray.view("uint8")
+    # bytes read by each segment, and whether there was more audio than room
+    bytesRead = [0] * segments
+    overflowed = [False] * segments
+
+    def readSegment(segNo, pipe, preroll, segmentBuffer):
+        readPipeInto(pipe, bytearray(preroll))
+        with memoryview(segmentBuffer) as view:
+            while bytesRead[segNo] < len(view):
+                chunkSize = pipe.stdout.readinto(view[bytesRead[segNo] :])
+                if not chunkSize:
+                    break
+                bytesRead[segNo] += chunkSize
+        if segmentEnds[segNo] is None and bytesRead[segNo] == len(segmentBuffer):
+            overflowed[segNo] = bool(pipe.stdout.read(1))
+
+    pipes = []
+    threads = []
+    for segNo, (segmentStart, segmentEnd) in enumerate(
+        zip(segmentStarts, segmentEnds)
+    ):
+        seekTime = max(0, segmentStart - DECODE_PREROLL)
+        if segmentEnd is not None:
+            # FFmpeg stops at the end of the segment instead of being killed
+            segmentDuration = segmentEnd - seekTime
+        else:
+            # the last segment is read to the end of the window
+            segmentDuration = None if window is None else window - seekTime
+        pipe = openPipe(
+            createDecodeCommand(filename, startTime + seekTime, segmentDuration),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+        )
+        pipes.append(pipe)
+        end = len(buffer) - 88200 if segmentEnd is None else segmentEnd * 88200
+        thread = threading.Thread(
+            target=readSegment,
+            name="Audio segment #%s" % segNo,
+            args=(
+                segNo,
+                pipe,
+                (segmentStart - seekTime) * 88200,
+                buffer[segmentStart * 88200 : end],
+            ),
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+
+    log.info("Decoding the audio in %s segments", segments)
+    lastPercent = None
+    try:
+        while any(thread.is_alive() for thread in threads):
+            if Core.canceled:
+                return
+            for thread in threads:
+                thread.join(timeout=0.1 / segments)
+            percent = min(100, int(100 * sum(bytesRead) / (duration * 88200)))
+            if lastPercent != percent:
+                string = "Loading audio file: " + str(percent) + "%"
+                videoWorker.progressBarSetText.emit(string)
+                videoWorker.progressBarUpdate.emit(percent)
+            lastPercent = percent
+    finally:
+        for pipe in pipes:
+            pipe.kill()
+            pipe.wait()
+        for thread in threads:
+            thread.join()
+
+    shortSegments = [
+        segNo
+        for segNo, segmentEnd in enumerate(segmentEnds[:-1])
+        if bytesRead[segNo] != (segmentEnd - segmentStarts[segNo]) * 88200
+    ]
+    if shortSegments or overflowed[-1]:
+        log.warning(
+            "Decoding the audio again without segments: %s",
+            "it is longer than expected" if overflowed[-1] else "segments are short",
+        )
+        return
+
+    # the samples read and the 0s at the end
+    return completeAudioArray[: segmentStarts[-1] * 44100 + bytesRead[-1] // 2 + 44100]
+
+
+def readPipeInto(pipe, buffer):
+    """
+    Reads the stdout of pipe into buffer until it is full or the pipe ends.
+    Returns the number of bytes read
+    """
+    bytesRead = 0
+    with memoryview(buffer) as view:
+        while bytesRead < len(view):
+            chunkSize = pipe.stdout.readinto(view[bytesRead:])
+            if not chunkSize:
+                break
+            bytesRead += chunkSize
+    return bytesRead
+
+
 def exampleSound(style="white", extra="apulsator=offset_l=0.35:offset_r=0.67"):
     """Help generate an example sound for use in creating a preview"""
 
@@ -550,9 +1659,8 @@ def exampleSound(style="white", extra="apulsator=offset_l=0.35:offset_r=0.67"):
 
 def checkFfmpegVersion():
     try:
-        with open(os.devnull, "w") as f:
-            ffmpegVers = checkOutput([Core.FFMPEG_BIN, "-version"], stderr=f)
-        ffmpegVers = str(ffmpegVers).split()[2].split(".", 1)[0]
+        ffmpegVers = getFfmpegOutput("-version")
+        ffmpegVers = ffmpegVers.split()[2].split(".", 1)[0]
         if ffmpegVers.startswith("n"):
             ffmpegVers = ffmpegVers[1:]
         versionNum = int(ffmpegVers)
@@ -6,6 +6,8 @@ from PyQt6 import QtGui
 from PIL import Image, ImageEnhance, ImageChops, ImageFilter
 from PIL.ImageQt import ImageQt
 from PyQt6 import QtCore
+from queue import Queue
+import numpy
 import sys
 import os
 import math
@@ -47,6 +49,54 @@ class FramePainter(QtGui.QPainter):
         return frame
 
 
+class FrameBuffers:
+    """
+    A fixed number of preallocated RGBA frames (numpy arrays) which are
+    reused for every exported frame, so finished frames can be written
+    to FFmpeg without creating a new bytes object for each one.
+    """
+
+    def __init__(self, width, height, count):
+        self.freeBuffers = Queue()
+        for _ in range(count):
+            self.freeBuffers.put(numpy.zeros((height, width, 4), dtype="uint8"))
+
+    def get(self):
+        """Waits until a buffer is no longer in use, then returns it"""
+        return self.freeBuffers.get()
+
+    def release(self, buffer):
+        self.freeBuffers.put(buffer)
+
+
+def copyFrameInto(frame, buffer):
+    """Copies an RGBA Pillow image into a writable buffer of the same size"""
+    image = Image.frombuffer("RGBA", frame.size, buffer, "raw", "RGBA", 0, 1)
+    frame.load()
+    # Image.paste would copy the read-only image of the buffer first, so the
+    # frame is pasted by the image core which is mapped onto the buffer.
+    # (numpy.asarray(frame) makes a bytes object of the frame, and is slower)
+    image.im.paste(frame.im, (0, 0, *frame.size))
+
+
+def FrameFromBytes(imageData, size):
+    """
+    Wraps the raw RGBA bytes of a frame from FFmpeg in a Pillow image without
+    copying them. Pillow copies the image before changing it, since it's
+    read-only. Raises ValueError if imageData is too short (e.g., empty)
+    """
+    return Image.frombuffer("RGBA", size, imageData, "raw", "RGBA", 0, 1)
+
+
+def PaddedFrame(image, offset, width, height):
+    """Places an image at offset (x, y) on a blank frame of the given size"""
+    if offset == (0, 0) and image.size == (width, height):
+        return image
+    frame = BlankFrame(width, height)
+    frame.paste(image, box=offset)
+    return frame
+
+
 def addShadow(frame, blurRadius, blurOffsetX, blurOffsetY):
     shadImg = ImageEnhance.Contrast(frame).enhance(0.0)
     shadImg = shadImg.filter(ImageFilter.GaussianBlur(blurRadius))
@@ -1,7 +1,302 @@
 """Functions used to transform and manipulate audio for use by visualizers"""
 
-from copy import copy
+from functools import lru_cache
 import numpy
+import logging
+
+
+log = logging.getLogger("AVP.Toolkit.Visualizer")
+
+
+# each frame of audio is padded to this many samples before its FFT
+PADDED_SAMPLE_SIZE = 2048
+# number of frequency bins in each spectrum
+SPECTRUM_BINS = PADDED_SAMPLE_SIZE // 2 - 1
+# frames transformed at once by createSpectrumArray
+BATCH_FRAMES = 512
+# up to this many bins are computed directly instead of by a whole FFT
+DIRECT_TRANSFORM_BINS = 16
+
+
+class SpectrumCache:
+    """
+    The spectrum analyses of the audio of one export, shared by its
+    components. Components which ask for the spectrum with the same sample
+    size, smoothing constants and scale get the same spectrumArray, so the
+    audio is analyzed (and the progress reported) only once for all of them.
+    An analysis of some bins is also shared with components which need only
+    some of those bins. The spectrumArrays must not be changed by the
+    components.
+
+    If streaming is True the spectra are analyzed while the frames are
+    rendered (see StreamingSpectrumArray) instead of before the export.
+
+    If analysisCache (see toolkit.cache) is given, analyses of the audio
+    identified by audioKey are loaded from it, or saved to it once complete
+    """
+
+    def __init__(
+        self,
+        completeAudioArray,
+        progressBarUpdate,
+        progressBarSetText,
+        dtype="float32",
+        streaming=False,
+        analysisCache=None,
+        audioKey=None,
+    ):
+        self.completeAudioArray = completeAudioArray
+        self.progressBarUpdate = progressBarUpdate
+        self.progressBarSetText = progressBarSetText
+        # how the spectra are stored (see SpectrumArray)
+        self.dtype = dtype
+        self.streaming = streaming
+        self.analysisCache = analysisCache
+        self.audioKey = audioKey
+        self.spectrumArrays = {}
+
+    def spectrumArray(
+        self,
+        component,
+        sampleSize,
+        smoothConstantDown,
+        smoothConstantUp,
+        scale,
+        bins=None,
+    ):
+        """Returns what createSpectrumArray would for component"""
+        key = (sampleSize, smoothConstantDown, smoothConstantUp, scale)
+        bins = None if bins is None else tuple(sorted(set(bins)))
+        for cachedBins, spectrumArray in self.spectrumArrays.get(key, {}).items():
+            if cachedBins is None or (
+                bins is not None and set(bins).issubset(cachedBins)
+            ):
+                log.debug("%s shares the spectrum analysis %s", component, key)
+                return spectrumArray
+
+        spectrumKey = None
+        # streaming analyses are kept as float32
+        dtype = "float32" if self.streaming else self.dtype
+        if self.analysisCache is not None:
+            spectrumKey = self.analysisCache.spectrumKey(
+                self.audioKey, *key, bins, dtype
+            )
+            spectra = self.analysisCache.loadSpectrum(spectrumKey)
+            if spectra is not None:
+                spectrumArray = SpectrumArray(
+                    len(spectra), sampleSize, dtype, bins, spectra
+                )
+                self.spectrumArrays.setdefault(key, {})[bins] = spectrumArray
+                return spectrumArray
+
+        if self.streaming:
+            spectrumArray = StreamingSpectrumArray(
+                self.completeAudioArray,
+                sampleSize,
+                smoothConstantDown,
+                smoothConstantUp,
+                scale,
+                bins,
+                self.analysisCache,
+                spectrumKey,
+            )
+            self.spectrumArrays.setdefault(key, {})[bins] = spectrumArray
+            return spectrumArray
+        spectrumArray = createSpectrumArray(
+            component,
+            self.completeAudioArray,
+            sampleSize,
+            smoothConstantDown,
+            smoothConstantUp,
+            scale,
+            self.progressBarUpdate,
+            self.progressBarSetText,
+            self.dtype,
+            bins,
+        )
+        # an analysis stopped by canceling the export is incomplete
+        if not component.canceled:
+            self.spectrumArrays.setdefault(key, {})[bins] = spectrumArray
+            if self.analysisCache is not None:
+                self.analysisCache.saveSpectrum(spectrumKey, spectrumArray.spectra)
+        return spectrumArray
+
+    def close(self):
+        """
+        Called once the frames are rendered, or the export is canceled, to
+        remove the files of streaming analyses which didn't reach the end
+        """
+        for spectrumArrays in self.spectrumArrays.values():
+            for spectrumArray in spectrumArrays.values():
+                if isinstance(spectrumArray, StreamingSpectrumArray):
+                    spectrumArray.close()
+
+
+class SpectrumArray:
+    """
+    The spectrum of each frame of audio, stored as the rows of one 2D array
+    (float32, or float16 to halve the memory used by long audio). Like the
+    dict it replaces, it is indexed by the first sample of a frame, which
+    is a multiple of sampleSize. A row is returned as a float32 array.
+
+    If bins is given only those bins of each spectrum are stored, as the
+    columns of the 2D array, and the other bins of a returned row are 0.
+    Such a row is expanded into the same array for every frame, so it's only
+    valid until another frame is read. The 2D array is created unless
+    spectra (e.g., a cached one) is given
+    """
+
+    def __init__(
+        self, frameCount, sampleSize, dtype="float32", bins=None, spectra=None
+    ):
+        self.sampleSize = sampleSize
+        self.bins = None if bins is None else numpy.array(bins, dtype=int)
+        self.expandedRow = ExpandedRow(self.bins)
+        if spectra is None:
+            spectra = numpy.zeros(
+                (frameCount, SPECTRUM_BINS if bins is None else len(bins)),
+                dtype=dtype,
+            )
+        self.spectra = spectra
+
+    def __getitem__(self, sampleNo):
+        frameNo, offset = divmod(sampleNo, self.sampleSize)
+        if offset != 0 or not 0 <= frameNo < len(self.spectra):
+            raise KeyError(sampleNo)
+        if self.bins is None:
+            return self.spectra[frameNo].astype("float32", copy=False)
+        return self.expandedRow.get(frameNo, self.spectra)
+
+    def __len__(self):
+        return len(self.spectra)
+
+
+class ExpandedRow:
+    """
+    The full spectrum of the last frame read from the spectra of some bins,
+    kept in one array so reading a frame's bins one by one doesn't create
+    a new array each time
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.frameNo = None
+        self.spectrum = None
+
+    def get(self, frameNo, spectra, firstFrameNo=0):
+        """Returns the spectrum of frameNo, row frameNo - firstFrameNo of spectra"""
+        if frameNo != self.frameNo:
+            if self.spectrum is None:
+                self.spectrum = numpy.zeros(SPECTRUM_BINS, dtype="float32")
+            self.spectrum[self.bins] = spectra[frameNo - firstFrameNo]
+            self.frameNo = frameNo
+        return self.spectrum
+
+
+class StreamingSpectrumArray:
+    """
+    Used like a SpectrumArray, but the spectra are analyzed on demand in
+    batches of BATCH_FRAMES frames, carrying the smoothing forward from one
+    batch to the next. Only the batch of the frame being rendered and the
+    batch before it are kept, so the memory used doesn't depend on the length
+    of the audio. The spectra are the same as createSpectrumArray's.
+
+    Frames should be read in order: skipping ahead analyzes the frames in
+    between (their smoothing affects the later ones), and going back to an
+    earlier batch than the two which are kept starts again from the first.
+
+    If analysisCache is given the spectra are also written to a file, which
+    is saved as spectrumKey once every frame has been analyzed. close()
+    removes the file if they weren't all analyzed
+    """
+
+    def __init__(
+        self,
+        completeAudioArray,
+        sampleSize,
+        smoothConstantDown,
+        smoothConstantUp,
+        scale,
+        bins=None,
+        analysisCache=None,
+        spectrumKey=None,
+    ):
+        self.completeAudioArray = completeAudioArray
+        self.sampleSize = sampleSize
+        self.smoothConstantDown = smoothConstantDown
+        self.smoothConstantUp = smoothConstantUp
+        self.scale = scale
+        self.bins = None if bins is None else numpy.array(bins, dtype=int)
+        self.binsTuple = None if bins is None else tuple(bins)
+        self.expandedRow = ExpandedRow(self.bins)
+        self.frameCount = len(range(0, len(completeAudioArray), sampleSize))
+        self.analysisCache = analysisCache
+        self.spectrumKey = spectrumKey
+        self.savedSpectra = None
+        self.rewind()
+
+    def rewind(self):
+        # batches are kept as (first frame, spectra) with the latest at the end
+        self.batches = []
+        self.endFrameNo = 0
+        self.lastSpectrum = None
+
+    def analyzeNextBatch(self):
+        firstFrameNo = self.endFrameNo
+        self.endFrameNo = min(firstFrameNo + BATCH_FRAMES, self.frameCount)
+        spectra = transformFrames(
+            self.completeAudioArray,
+            self.sampleSize,
+            firstFrameNo,
+            self.endFrameNo,
+            self.scale,
+            self.binsTuple,
+        )
+        smoothSpectra(
+            spectra, self.lastSpectrum, self.smoothConstantDown, self.smoothConstantUp
+        )
+        self.lastSpectrum = spectra[-1]
+        self.batches = self.batches[-1:] + [(firstFrameNo, spectra)]
+        if self.analysisCache is None:
+            return
+        if self.savedSpectra is None:
+            # created once the frames are rendered, so a render process which
+            # fails to start or is canceled beforehand leaves no file behind
+            self.savedSpectra = self.analysisCache.createSpectrum(
+                self.spectrumKey, (self.frameCount, spectra.shape[1]), "float32"
+            )
+        # every batch is analyzed in order from the first one
+        self.savedSpectra[firstFrameNo : self.endFrameNo] = spectra
+        if self.endFrameNo == self.frameCount:
+            self.analysisCache.saveSpectrum(self.spectrumKey, self.savedSpectra)
+            self.savedSpectra = None
+            # analyzing it again doesn't save it again
+            self.analysisCache = None
+
+    def close(self):
+        """Removes the file of the spectra if they weren't all analyzed"""
+        if self.savedSpectra is not None:
+            self.analysisCache.discardSpectrum(self.savedSpectra)
+            self.savedSpectra = None
+
+    def __getitem__(self, sampleNo):
+        frameNo, offset = divmod(sampleNo, self.sampleSize)
+        if offset != 0 or not 0 <= frameNo < self.frameCount:
+            raise KeyError(sampleNo)
+        if self.batches and frameNo < self.batches[0][0]:
+            log.debug("Analyzing the spectrum again to go back to frame %s", frameNo)
+            self.rewind()
+        while frameNo >= self.endFrameNo:
+            self.analyzeNextBatch()
+        firstFrameNo, spectra = next(
+            batch for batch in reversed(self.batches) if frameNo >= batch[0]
+        )
+        if self.bins is None:
+            return spectra[frameNo - firstFrameNo]
+        return self.expandedRow.get(frameNo, spectra, firstFrameNo)
+
+    def __len__(self):
+        return self.frameCount
 
 
 def createSpectrumArray(
@@ -13,27 +308,32 @@ def createSpectrumArray(
     scale,
     progressBarUpdate,
     progressBarSetText,
+    dtype="float32",
+    bins=None,
 ):
+    """
+    Returns a SpectrumArray of the smoothed spectrum of each frame of audio,
+    stored as dtype. Frames are transformed in batches by transformFrames,
+    which gives the same spectra as calling transformData on each frame.
+    If bins is given only those bins are computed and stored
+    """
     lastProgress = 0
     lastSpectrum = None
-    spectrumArray = {}
-    for i in range(0, len(completeAudioArray), sampleSize):
+    frameCount = len(range(0, len(completeAudioArray), sampleSize))
+    spectrumArray = SpectrumArray(frameCount, sampleSize, dtype, bins)
+    for firstFrameNo in range(0, frameCount, BATCH_FRAMES):
         if component.canceled:
             break
-        lastSpectrum = transformData(
-            i,
-            completeAudioArray,
-            sampleSize,
-            smoothConstantDown,
-            smoothConstantUp,
-            lastSpectrum,
-            scale,
+        endFrameNo = min(firstFrameNo + BATCH_FRAMES, frameCount)
+        spectra = transformFrames(
+            completeAudioArray, sampleSize, firstFrameNo, endFrameNo, scale, bins
         )
-        spectrumArray[i] = copy(lastSpectrum)
+        smoothSpectra(spectra, lastSpectrum, smoothConstantDown, smoothConstantUp)
+        # smoothing carries on from the float32 spectrum, not the stored one
+        lastSpectrum = spectra[-1]
+        spectrumArray.spectra[firstFrameNo:endFrameNo] = spectra
 
-        progress = int(100 * (i / len(completeAudioArray)))
-        if progress >= 100:
-            progress = 100
+        progress = min(100, int(100 * endFrameNo / frameCount))
         if progress == lastProgress:
             continue
         progressText = f"Analyzing audio: {str(progress)}%"
@@ -43,6 +343,106 @@ def createSpectrumArray(
     return spectrumArray
 
 
+@lru_cache
+def hanningWindow(sampleSize):
+    window = numpy.hanning(sampleSize)
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache
+def directTransformBasis(sampleSize, bins):
+    """
+    The windowed cosines and sines of the bins (a tuple) of the padded FFT,
+    as columns, so that frames @ basis gives the real and imaginary parts
+    """
+    phase = numpy.outer(
+        numpy.arange(sampleSize),
+        numpy.array(bins) * (2 * numpy.pi / PADDED_SAMPLE_SIZE),
+    )
+    window = hanningWindow(sampleSize)[:, numpy.newaxis]
+    basis = numpy.concatenate(
+        (numpy.cos(phase) * window, -numpy.sin(phase) * window), axis=1
+    )
+    basis.flags.writeable = False
+    return basis
+
+
+def transformFrames(
+    completeAudioArray, sampleSize, firstFrameNo, endFrameNo, scale, bins=None
+):
+    """
+    Returns the unsmoothed spectra of frames firstFrameNo up to endFrameNo
+    as the rows of a float32 array, using one FFT for all of them.
+    The FFT itself is done in float64, which numpy computes faster.
+    If bins (a tuple) is given the rows have only those bins, and a few bins
+    are computed directly, which is much faster than the whole FFT
+    """
+    start = firstFrameNo * sampleSize
+    end = min(endFrameNo * sampleSize, len(completeAudioArray))
+    # the frames of audio are consecutive, so the rows of a reshaped view
+    fullFrames = (end - start) // sampleSize
+    frames = completeAudioArray[start : start + fullFrames * sampleSize].reshape(
+        fullFrames, sampleSize
+    )
+    columns = slice(SPECTRUM_BINS) if bins is None else list(bins)
+    spectra = numpy.empty(
+        (endFrameNo - firstFrameNo, SPECTRUM_BINS if bins is None else len(bins)),
+        dtype="float32",
+    )
+    if bins is not None and len(bins) <= DIRECT_TRANSFORM_BINS:
+        parts = frames @ directTransformBasis(sampleSize, bins)
+        numpy.hypot(
+            parts[:, : len(bins)], parts[:, len(bins) :], out=spectra[:fullFrames]
+        )
+    else:
+        spectra[:fullFrames] = numpy.abs(
+            numpy.fft.rfft(frames * hanningWindow(sampleSize), PADDED_SAMPLE_SIZE)[
+                :, columns
+            ]
+        )
+    if fullFrames < len(spectra):
+        # the last frame is shorter and has its own window
+        lastFrame = completeAudioArray[start + fullFrames * sampleSize : end]
+        spectra[-1] = numpy.abs(
+            numpy.fft.rfft(
+                lastFrame * hanningWindow(len(lastFrame)), PADDED_SAMPLE_SIZE
+            )[columns]
+        )
+
+    with numpy.errstate(divide="ignore"):
+        numpy.log10(spectra, out=spectra)
+    spectra *= scale
+    spectra[numpy.isinf(spectra)] = 0
+    return spectra
+
+
+def smoothSpectra(spectra, lastSpectrum, smoothConstantDown, smoothConstantUp):
+    """
+    Smooths consecutive spectra in place, like transformData: each bin falls
+    towards a lower value by smoothConstantDown and rises towards a higher
+    one by smoothConstantUp, which are at most 1. lastSpectrum is the
+    smoothed spectrum before the first one, or None if the first one is
+    the start of the audio
+    """
+    start = 0
+    if lastSpectrum is None:
+        lastSpectrum = spectra[0]
+        start = 1
+    bins = spectra.shape[1]
+    change = numpy.empty(bins, dtype="float32")
+    falling = numpy.empty(bins, dtype=bool)
+    rate = numpy.empty(bins, dtype="float32")
+    for spectrum in spectra[start:]:
+        numpy.subtract(spectrum, lastSpectrum, out=change)
+        numpy.less(change, 0, out=falling)
+        numpy.multiply(falling, smoothConstantDown - smoothConstantUp, out=rate)
+        rate += smoothConstantUp
+        change *= rate
+        numpy.add(lastSpectrum, change, out=spectrum)
+        lastSpectrum = spectrum
+
+
 def transformData(
     i,
     completeAudioArray,
@@ -13,16 +13,30 @@ from PyQt6.QtCore import pyqtSignal, pyqtSlot
 from PIL import Image
 from PIL.ImageQt import ImageQt
 
+from functools import partial
 import numpy
 import subprocess as sp
 import sys
 import os
 import signal
+import shutil
+import tempfile
 import logging
 
 from .libcomponent import ComponentError
+from .render_pool import RenderPool, warmUpComponents
+from .segmented_export import SegmentedExport
+from .native_export import NativeExport, findFfmpegLayers
 from .toolkit import formatTraceback
+from .toolkit.frame import FrameBuffers
+from .toolkit.compositor import Compositor, Layer
+from .toolkit.visualizer import SpectrumCache
+from .toolkit.cache import AnalysisCache
 from .toolkit.ffmpeg import (
+    FfmpegAudioGraph,
+    DecoderScheduler,
+    FrameWriter,
+    TimestampedFrameWriter,
     openPipe,
     readAudioFile,
     getAudioDuration,
@@ -32,6 +46,10 @@ from .toolkit.ffmpeg import (
 
 log = logging.getLogger("AVP.VideoThread")
 
+# frames of audio analyzed before the start of a partial export (one second),
+# so smoothing has settled. Components can ask for more with warmupFrames()
+PREROLL_FRAMES = 30
+
 
 class Worker(QtCore.QObject):
 
@@ -48,6 +66,44 @@ class Worker(QtCore.QObject):
         self.modules = parent.core.modules
         parent.createVideo.connect(self.createVideo)
         self.previewEnabled = type(parent.core).previewEnabled
+        self.jobs = type(parent.core).renderJobs
+        if self.jobs is None:
+            self.jobs = int(self.settings.value("pref_renderJobs"))
+        if self.jobs < 1:
+            self.jobs = os.cpu_count()
+        self.segments = type(parent.core).exportSegments
+        if self.segments is None:
+            self.segments = int(self.settings.value("pref_exportSegments"))
+        if self.segments < 1:
+            self.segments = os.cpu_count()
+        # number of FFmpeg processes decoding long audio at once
+        self.decodeJobs = int(self.settings.value("pref_decodeJobs"))
+        if self.decodeJobs < 1:
+            self.decodeJobs = os.cpu_count()
+        # number of FFmpeg processes decoding the frames of layers at once
+        self.videoDecoders = int(self.settings.value("pref_videoDecoders"))
+        if self.videoDecoders < 1:
+            # the other half of the cores encode and render
+            self.videoDecoders = max(1, os.cpu_count() // 2)
+        self.resumable = type(parent.core).resumableExport
+        if self.resumable is None:
+            self.resumable = self.settings.value("pref_resumableExport")
+        # whether repeated frames are dropped from a variable frame rate video
+        self.skipRepeatedFrames = self.settings.value("pref_skipRepeatedFrames")
+        # whether FFmpeg draws the frames when every component lets it
+        self.nativeExport = self.settings.value("pref_nativeExport")
+        # decoded audio and spectrum analyses kept for exports of the same audio
+        self.analysisCache = None
+        if self.settings.value("pref_analysisCache"):
+            self.analysisCache = AnalysisCache(
+                type(parent.core).cacheDir,
+                int(self.settings.value("pref_analysisCacheSize")) * 2**20,
+            )
+        # identifies the audio in the analysis cache once it is loaded
+        self.audioKey = None
+        # seconds of the audio to export, the end being None for all of it
+        self.startTime = type(parent.core).exportStart or 0.0
+        self.endTime = type(parent.core).exportEnd
 
         self.components = components
         self.outputFile = outputFile
@@ -57,8 +113,12 @@ class Worker(QtCore.QObject):
         self.sampleSize = 1470  # 44100 / 30 = 1470
         self.canceled = False
         self.error = False
+        self.out_pipe = None
+        self.frameWriter = None
+        self.renderPool = None
+        self.spectrumCache = None
 
-    def createFfmpegCommand(self, duration):
+    def createFfmpegCommand(self, duration, stillImage=None, filterGraph=None):
         try:
             ffmpegCommand = createFfmpegCommand(
                 self.inputFile,
@@ -66,6 +126,14 @@ class Worker(QtCore.QObject):
                 self.components,
                 duration,
                 "info" if log.getEffectiveLevel() < logging.WARNING else "error",
+                startTime=self.startTime,
+                stillImage=stillImage,
+                timestampedFrames=(
+                    self.skipRepeatedFrames
+                    and stillImage is None
+                    and filterGraph is None
+                ),
+                filterGraph=filterGraph,
             )
         except sp.CalledProcessError as e:
             # FIXME video_thread should own this error signal, not components
@@ -87,35 +155,123 @@ class Worker(QtCore.QObject):
             return
         return ffmpegCommand
 
-    def determineAudioLength(self):
+    def determineAudioLength(self, decodeAudio=True):
         """
         Returns audio length which determines length of final video, or False if failure occurs
+        A partial export only loads its own part of the audio, starting with a short
+        pre-roll of self.firstFrameNo frames which are analyzed but not exported.
+        Unless decodeAudio is True and a component needs the audio, the length
+        comes from the probed duration instead of the decoded audio
         """
-        if any(
+        # seconds into the audio file where frame 0 begins
+        self.audioStart = 0.0
+        self.firstFrameNo = 0
+        window = None
+        if self.startTime or self.endTime:
+            window = self.determineExportWindow()
+            if not window:
+                return False
+
+        if decodeAudio and any(
             [True if "pcm" in comp.properties() else False for comp in self.components]
         ):
-            self.progressBarSetText.emit("Loading audio file...")
-            audioFileTraits = readAudioFile(self.inputFile, self)
+            audioFileTraits = self.loadAudio(window)
             if audioFileTraits is None:
                 self.cancelExport()
                 return False
             self.completeAudioArray, duration = audioFileTraits
             self.audioArrayLen = len(self.completeAudioArray)
         else:
-            duration = getAudioDuration(self.inputFile)
+            duration = window or getAudioDuration(self.inputFile)
             self.completeAudioArray = []
             self.audioArrayLen = int(
                 ((duration * self.hertz) + self.hertz) - self.sampleSize
             )
-        return duration
+        return duration - self.firstFrameNo * self.sampleSize / self.hertz
 
-    def preFrameRender(self):
+    def loadAudio(self, window):
+        """
+        Returns what readAudioFile does, loading the decoded audio from the
+        analysis cache if it was saved there by an earlier export
+        """
+        self.audioKey = None
+        if self.analysisCache is not None:
+            try:
+                self.audioKey = self.analysisCache.audioKey(
+                    self.inputFile, self.audioStart, window
+                )
+            except OSError:
+                # readAudioFile reports that the file can't be read
+                pass
+        if self.audioKey is not None:
+            audioFileTraits = self.analysisCache.loadAudio(self.audioKey)
+            if audioFileTraits is not None:
+                return audioFileTraits
+
+        self.progressBarSetText.emit("Loading audio file...")
+        audioFileTraits = readAudioFile(
+            self.inputFile, self, self.audioStart, window, self.decodeJobs
+        )
+        if audioFileTraits is not None and self.audioKey is not None:
+            self.analysisCache.saveAudio(self.audioKey, *audioFileTraits)
+        return audioFileTraits
+
+    def determineExportWindow(self):
+        """
+        Sets the pre-roll of a partial export and returns the seconds of audio
+        to load from self.audioStart, or False if the time range is invalid
+        """
+        fileDuration = getAudioDuration(self.inputFile)
+        if not fileDuration:
+            self.cancelExport()
+            return False
+        endTime = fileDuration if not self.endTime else min(self.endTime, fileDuration)
+        if self.startTime >= endTime:
+            # FIXME video_thread should own this error signal, not components
+            self.components[0]._error.emit(
+                "The export must start before it ends.",
+                "Start: %ss, end: %ss" % (self.startTime, endTime),
+            )
+            self.failExport()
+            return False
+        preroll = max(
+            [PREROLL_FRAMES] + [comp.warmupFrames() for comp in self.components]
+        )
+        self.firstFrameNo = min(
+            preroll, int(self.startTime * self.hertz / self.sampleSize)
+        )
+        self.audioStart = (
+            self.startTime - self.firstFrameNo * self.sampleSize / self.hertz
+        )
+        return endTime - self.audioStart
+
+    def preFrameRender(self, nativeComponents=()):
         """
         Initializes components that need to pre-compute stuff.
         Also prerenders "static" components like text and merges them if possible
+        Components in nativeComponents are drawn by FFmpeg, so aren't initialized
         """
         self.staticComponents = {}
         self.compositeComponents = set()
+        self.compositor = Compositor(self.width, self.height)
+        # components with the same spectrum analysis share it
+        halfPrecision = self.settings.value("pref_halfPrecisionSpectrum")
+        self.spectrumCache = SpectrumCache(
+            self.completeAudioArray,
+            self.progressBarUpdate,
+            self.progressBarSetText,
+            # halves the memory used to analyze long audio
+            "float16" if halfPrecision else "float32",
+            # analyze while rendering so the first frames are exported sooner
+            streaming=self.settings.value("pref_streamingSpectrum"),
+            analysisCache=None if self.audioKey is None else self.analysisCache,
+            audioKey=self.audioKey,
+        )
+        decoderScheduler = DecoderScheduler(self.videoDecoders)
+        # components whose FFmpeg filters can share one decode of the audio
+        ffmpegAudioGraph = FfmpegAudioGraph(
+            self.inputFile, self.audioStart, decoderScheduler
+        )
 
         # Call preFrameRender on each component
         canceledByComponent = False
@@ -129,14 +285,19 @@ class Worker(QtCore.QObject):
         log.info("Calling preFrameRender for %s", initText)
         for compNo, comp in enumerate(reversed(self.components)):
             try:
-                comp.preFrameRender(
-                    audioFile=self.inputFile,
-                    completeAudioArray=self.completeAudioArray,
-                    audioArrayLen=self.audioArrayLen,
-                    sampleSize=self.sampleSize,
-                    progressBarUpdate=self.progressBarUpdate,
-                    progressBarSetText=self.progressBarSetText,
-                )
+                if comp not in nativeComponents:
+                    comp.preFrameRender(
+                        audioFile=self.inputFile,
+                        audioStart=self.audioStart,
+                        completeAudioArray=self.completeAudioArray,
+                        audioArrayLen=self.audioArrayLen,
+                        sampleSize=self.sampleSize,
+                        progressBarUpdate=self.progressBarUpdate,
+                        progressBarSetText=self.progressBarSetText,
+                        spectrumCache=self.spectrumCache,
+                        ffmpegAudioGraph=ffmpegAudioGraph,
+                        decoderScheduler=decoderScheduler,
+                    )
             except ComponentError:
                 log.warning(
                     "#%s %s encountered an error in its preFrameRender method",
@@ -204,11 +365,31 @@ class Worker(QtCore.QObject):
                 self.staticComponents[compNo] = None
 
         mergeConsecutiveStaticComponentFrames(self)
+        for layerNo, frame in self.staticComponents.items():
+            if frame is not None:
+                self.staticComponents[layerNo] = Layer(frame)
+
+    def postFrameRender(self, nativeComponents=()):
+        """
+        Calls postFrameRender on the components initialized by preFrameRender
+        once their frames are rendered, or the export is canceled
+        """
+        for comp in reversed(self.components):
+            if comp not in nativeComponents:
+                comp.postFrameRender()
+        self.closeSpectrumCache()
+
+    def closeSpectrumCache(self):
+        if self.spectrumCache is None:
+            return
+        self.spectrumCache.close()
+        self.spectrumCache = None
 
-    def frameRender(self, audioI):
+    def frameRender(self, audioI, frameData):
         """
         Renders a frame composited together from the frames returned by each component
         audioI is a multiple of self.sampleSize, which can be divided to determine frameNo
+        The frame is written into frameData, a uint8 RGBA array of the output size
         """
 
         def err():
@@ -222,7 +403,7 @@ class Worker(QtCore.QObject):
             comp._error.emit(msg, details)
 
         bgI = int(audioI / self.sampleSize)
-        frame = None
+        self.compositor.clear()
         for layerNo, comp in enumerate(reversed((self.components))):
             if self.canceled:
                 break
@@ -232,25 +413,19 @@ class Worker(QtCore.QObject):
                         # this layer was merged into a following layer
                         continue
                     # static component
-                    if frame is None:  # bottom-most layer
-                        frame = self.staticComponents[layerNo]
-                    else:
-                        frame = Image.alpha_composite(
-                            frame, self.staticComponents[layerNo]
-                        )
+                    self.compositor.addLayer(self.staticComponents[layerNo])
 
                 elif layerNo in self.compositeComponents:
                     # component that uses previous frame to draw
-                    frame = Image.alpha_composite(frame, comp.frameRender(bgI, frame))
+                    self.compositor.addLayer(
+                        comp.frameRender(bgI, self.compositor.toImage())
+                    )
                 else:
                     # animated component
-                    if frame is None:  # bottom-most layer
-                        frame = comp.frameRender(bgI)
-                    else:
-                        frame = Image.alpha_composite(frame, comp.frameRender(bgI))
+                    self.compositor.addLayer(*comp.regionRender(bgI))
             except Exception as e:
                 err()
-        return frame
+        self.compositor.writeInto(frameData)
 
     def showPreview(self, frame):
         """
@@ -266,9 +441,12 @@ class Worker(QtCore.QObject):
     def createVideo(self):
         """
         1. Determine length of final video
-        2. Call preFrameRender on each component
+        2. Call preFrameRender on each component, or start a RenderPool
+           whose processes do so on their own copies of the components
+           (a SegmentedExport instead renders and encodes the whole video,
+           and may resume an earlier export which didn't finish)
         3. Create the main FFmpeg command
-        4. Open the out_pipe to FFmpeg process
+        4. Open the out_pipe to FFmpeg process and a FrameWriter to fill it
         5. Iterate over the audio data array and call frameRender on the components to get frames
         6. Close the out_pipe
         7. Call postFrameRender on each component
@@ -286,22 +464,61 @@ class Worker(QtCore.QObject):
         progressBarValue = 0
         self.progressBarUpdate.emit(progressBarValue)
 
+        stillImage = all("static" in comp.properties() for comp in self.components)
+        ffmpegLayers = None
+        if (
+            self.nativeExport
+            and not stillImage
+            and not (self.segments > 1 or self.resumable)
+        ):
+            # a segmented export renders its segments, so it can resume them
+            ffmpegLayers = findFfmpegLayers(self.components)
+
         # Determine longest length of audio which will be the final video's duration
         log.debug("Determining length of audio...")
-        duration = self.determineAudioLength()
+        duration = self.determineAudioLength(
+            # render and segment processes decode the audio on their own
+            decodeAudio=stillImage
+            or ffmpegLayers is not None
+            or not (self.segments > 1 or self.resumable or self.jobs > 1)
+        )
         if not duration:
             return
 
         # Call preFrameRender on each component to perform initialization
         self.progressBarUpdate.emit(0)
         self.progressBarSetText.emit("Starting components...")
-        self.preFrameRender()
-        if self.canceled:
+        if stillImage:
+            # Every frame is the same, so FFmpeg can repeat a single image
+            log.info("Exporting a still image because every component is static")
+            if self.exportStillImage(duration):
+                self.finishExport()
             return
+        if ffmpegLayers is not None:
+            # FFmpeg draws every frame, so none are rendered here
+            log.info("Exporting with a filtergraph drawing every component")
+            if NativeExport(self, ffmpegLayers, duration).run():
+                self.finishExport()
+            return
+        elif self.segments > 1 or self.resumable:
+            # Segment processes render and encode parts of the video on their own
+            log.info("Exporting with %s segment processes", self.segments)
+            self.exportSegments(duration)
+            self.finishExport()
+            return
+        elif self.jobs > 1:
+            # Render processes initialize their own copies of the components
+            log.info("Rendering with %s processes", self.jobs)
+            self.renderPool = RenderPool(self, self.jobs)
+        else:
+            self.preFrameRender()
+            if self.canceled:
+                return
 
         # Create FFmpeg command
         ffmpegCommand = self.createFfmpegCommand(duration)
         if not ffmpegCommand:
+            self.closeRenderPool()
             return
         cmd = " ".join(ffmpegCommand)
         print("###### FFMPEG COMMAND ######\n%s" % cmd)
@@ -316,10 +533,30 @@ class Worker(QtCore.QObject):
                 stdin=sp.PIPE,
                 stdout=sys.stdout,
                 stderr=sys.stdout,
+                # frames are written straight from our buffers
+                bufsize=0,
             )
         except sp.CalledProcessError:
             log.critical("Out_Pipe to FFmpeg couldn't be created!", exc_info=True)
             raise
+        # Frames are written to the pipe by another thread while we render
+        queueDepth = int(self.settings.value("pref_writerQueueDepth"))
+        if self.skipRepeatedFrames:
+            frameRate = int(self.settings.value("outputFrameRate"))
+            self.frameWriter = TimestampedFrameWriter(
+                self.out_pipe,
+                queueDepth,
+                self.width,
+                self.height,
+                frameRate,
+                # FFmpeg stops reading once the video is as long as the audio
+                round(duration * frameRate),
+            )
+        else:
+            self.frameWriter = FrameWriter(self.out_pipe, queueDepth)
+        if self.renderPool is None:
+            # enough buffers for a full queue, one being written and one being rendered
+            self.frameBuffers = FrameBuffers(self.width, self.height, queueDepth + 2)
 
         # =~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~=~
         # START CREATING THE VIDEO
@@ -328,23 +565,40 @@ class Worker(QtCore.QObject):
         self.progressBarUpdate.emit(progressBarValue)
         # Begin piping into ffmpeg!
         self.progressBarSetText.emit("Exporting video...")
-        for audioI in range(0, self.audioArrayLen, self.sampleSize):
+        if self.renderPool is None:
+            # Stateful components render the pre-roll of a partial export
+            warmUpComponents(self.components, self.firstFrameNo)
+        firstAudioI = self.firstFrameNo * self.sampleSize
+        for audioI in range(firstAudioI, self.audioArrayLen, self.sampleSize):
             if self.canceled:
                 break
             # fetch the next frame & add to the FFmpeg pipe
-            frame = self.frameRender(audioI)
+            if self.renderPool is None:
+                frameData = self.frameBuffers.get()
+                self.frameRender(audioI, frameData)
+                if self.error:
+                    break
+                releaseFrame = partial(self.frameBuffers.release, frameData)
+            else:
+                frameData = self.renderPool.nextFrame()
+                if frameData is None:
+                    self.renderPoolFailed()
+                    break
+                releaseFrame = self.renderPool.releaseFrame
 
             # Update live preview
             if self.previewEnabled:
-                self.showPreview(frame)
+                self.showPreview(
+                    Image.frombytes("RGBA", (self.width, self.height), frameData)
+                )
 
-            try:
-                self.out_pipe.stdin.write(frame.tobytes())
-            except Exception:
+            if not self.frameWriter.write(frameData, releaseFrame):
                 break
 
             # increase progress bar value
-            completion = (audioI / self.audioArrayLen) * 100
+            completion = (
+                (audioI - firstAudioI) / (self.audioArrayLen - firstAudioI)
+            ) * 100
             if progressBarValue + 1 <= completion:
                 progressBarValue = numpy.floor(completion).astype(int)
                 msg = "Exporting video: %s%%" % str(int(progressBarValue))
@@ -357,9 +611,73 @@ class Worker(QtCore.QObject):
 
         self.closePipe()
 
-        for comp in reversed(self.components):
-            comp.postFrameRender()
+        if self.renderPool is None:
+            self.postFrameRender()
+        else:
+            self.closeRenderPool()
+
+        self.finishExport()
+
+    def exportStillImage(self, duration):
+        """
+        Composites the only frame of a video whose components are all static,
+        and has FFmpeg encode it for the whole duration. Returns False if the
+        export was already ended because it couldn't be started
+        """
+        self.preFrameRender()
+        if self.canceled:
+            return False
+        tempDir = tempfile.mkdtemp(prefix="avp-still-")
+        try:
+            frameData = numpy.empty((self.height, self.width, 4), dtype="uint8")
+            self.frameRender(0, frameData)
+            if self.error:
+                return True
+            frame = Image.fromarray(frameData)
+            if self.previewEnabled:
+                self.showPreview(frame)
+
+            stillImage = os.path.join(tempDir, "frame.png")
+            frame.save(stillImage, compress_level=1)
+            ffmpegCommand = self.createFfmpegCommand(duration, stillImage)
+            if not ffmpegCommand:
+                return False
+            log.info(" ".join(ffmpegCommand))
+            self.progressBarSetText.emit("Encoding still image...")
+            self.out_pipe = openPipe(
+                ffmpegCommand, stdout=sys.stdout, stderr=sys.stdout
+            )
+            if self.out_pipe.wait() != 0 and not self.canceled:
+                # FIXME video_thread should own this error signal, not components
+                self.components[0]._error.emit(
+                    "FFmpeg could not encode the still image.",
+                    "Exit code: %s" % self.out_pipe.returncode,
+                )
+                self.error = True
+            self.out_pipe = None
+        finally:
+            shutil.rmtree(tempDir, ignore_errors=True)
+            # the components are torn down however the export ended
+            self.postFrameRender()
+        return True
+
+    def exportSegments(self, duration):
+        segmentedExport = SegmentedExport(
+            self,
+            self.segments,
+            duration,
+            # segments are kept beside the output file until it is complete
+            workDir=f"{self.outputFile}.segments" if self.resumable else None,
+        )
+        if segmentedExport.run() or self.canceled:
+            return
+        msg, detail = segmentedExport.error
+        log.critical(f"{msg}\n{detail}")
+        # FIXME video_thread should own this error signal, not components
+        self.components[0]._error.emit(msg, detail)
+        self.error = True
 
+    def finishExport(self):
         if self.canceled:
             print("Export Canceled")
             try:
@@ -382,6 +700,11 @@ class Worker(QtCore.QObject):
         self.videoCreated.emit()
 
     def closePipe(self):
+        if self.out_pipe is None:
+            return
+        if self.frameWriter is not None:
+            self.frameWriter.close()
+            self.frameWriter = None
         try:
             self.out_pipe.stdin.close()
         except (BrokenPipeError, OSError):
@@ -392,6 +715,21 @@ class Worker(QtCore.QObject):
             self.error = True
         self.out_pipe.wait()
 
+    def closeRenderPool(self):
+        if self.renderPool is None:
+            return
+        self.renderPool.close()
+        self.renderPool = None
+
+    def renderPoolFailed(self):
+        if self.canceled:
+            return
+        msg, detail = self.renderPool.error
+        log.critical(f"{msg}\n{detail}")
+        # FIXME video_thread should own this error signal, not components
+        self.components[0]._error.emit(msg, detail)
+        self.error = True
+
     def cancelExport(self, message="Export Canceled"):
         self.progressBarUpdate.emit(0)
         self.progressBarSetText.emit(message)
@@ -1,4 +1,6 @@
 import os
+import shutil
+import subprocess
 import tempfile
 import numpy
 
@@ -74,14 +76,17 @@ def initCore():
         configDir = getTestDataPath("config")
     unwanted = ["autosave.avp", "settings.ini"]
     for file in unwanted:
-        filename = os.path.join(configDir, "autosave.avp")
+        filename = os.path.join(configDir, file)
         if os.path.exists(filename):
             os.remove(filename)
     Core.storeSettings(configDir)
+    # render processes use the cache dir in configDir too, so it is the one
+    # emptied for each test rather than a new one
+    shutil.rmtree(Core.cacheDir, ignore_errors=True)
     return configDir if numWorkers > 0 else None
 
 
-def preFrameRender(audioData, comp):
+def preFrameRender(audioData, comp, **kwargs):
     """Prepares a component for calls to frameRender()"""
     comp.preFrameRender(
         audioFile=getTestDataPath("inputfiles/test.ogg"),
@@ -89,6 +94,7 @@ def preFrameRender(audioData, comp):
         sampleSize=1470,
         progressBarSetText=MockSignal(),
         progressBarUpdate=MockSignal(),
+        **kwargs,
     )
 
 
@@ -109,3 +115,14 @@ class MockVideoWorker:
 def imageDataSum(image):
     """Get sum of raw data of a Pillow Image object"""
     return numpy.asarray(image, dtype="int32").sum(dtype="int32")
+
+
+def readFrameHashes(videoFile):
+    """Get the MD5 of each decoded frame of a video file's video stream"""
+    output = subprocess.check_output(
+        [Core.FFMPEG_BIN, "-v", "error", "-i", videoFile]
+        + ["-map", "0:v", "-f", "framemd5", "-"]
+    ).decode()
+    return [
+        line.split(",")[-1].strip() for line in output.splitlines() if line[0] != "#"
+    ]
@@ -1,7 +1,12 @@
 import sys
 import os
+import shutil
 import tempfile
-from . import command, getTestDataPath, MockSignal
+from . import command, getTestDataPath, readFrameHashes, MockSignal
+from avp.toolkit.ffmpeg import getAudioDuration
+from avp.native_export import NativeExport, findFfmpegLayers
+from avp.segmented_export import SegmentedExport
+from avp.toolkit.cache import AnalysisCache
 from pytestqt import qtbot
 
 
@@ -34,3 +39,372 @@ def test_commandline_classic_export(qtbot, command):
     assert os.path.exists(outputFilename)
     # output video should be at least 200kb
     assert os.path.getsize(outputFilename) > 200000
+
+
+def test_commandline_parallel_export(qtbot, command):
+    """Export using two render processes"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "classic",
+        "color=255,255,255",
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+        "--jobs",
+        "2",
+    ]
+    command.parseArgs()
+    assert command.worker.jobs == 2
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=30000):
+        print(f"Test Video created at {outputFilename}")
+
+    assert os.path.exists(outputFilename)
+    assert os.path.getsize(outputFilename) > 200000
+
+
+def test_commandline_parallel_export_matches_serial(qtbot, command):
+    """Frames rendered by render processes are the same as the serial ones"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    frameHashes = []
+    for jobs in ("1", "2"):
+        outputFilename = os.path.join(outputDir, "output%s.mp4" % jobs)
+        sys.argv = [
+            "",
+            "-c",
+            "0",
+            "classic",
+            "color=255,255,255",
+            "-i",
+            soundFile,
+            "-o",
+            outputFilename,
+            "--jobs",
+            jobs,
+        ]
+        command.core.clearComponents()
+        command.parseArgs()
+
+        with qtbot.waitSignal(command.worker.videoCreated, timeout=30000):
+            print(f"Test Video created at {outputFilename}")
+
+        frameHashes.append(readFrameHashes(outputFilename))
+    assert len(frameHashes[0]) == 122
+    assert frameHashes[1] == frameHashes[0]
+
+
+def test_commandline_segmented_export(qtbot, command):
+    """Export two segments in parallel and join them"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "classic",
+        "color=255,255,255",
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+        "--segments",
+        "2",
+    ]
+    command.parseArgs()
+    assert command.worker.segments == 2
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=30000):
+        print(f"Test Video created at {outputFilename}")
+
+    assert os.path.exists(outputFilename)
+    assert os.path.getsize(outputFilename) > 200000
+
+
+def test_commandline_export_uses_analysis_cache(qtbot, command, monkeypatch):
+    """Exporting the same audio again loads the decoded audio from the cache"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    loaded = []
+    loadAudio = AnalysisCache.loadAudio
+
+    def checkAudio(self, key):
+        audioFileTraits = loadAudio(self, key)
+        loaded.append(audioFileTraits is not None)
+        return audioFileTraits
+
+    monkeypatch.setattr(AnalysisCache, "loadAudio", checkAudio)
+    for _ in range(2):
+        sys.argv = [
+            "",
+            "-c",
+            "0",
+            "classic",
+            "color=255,255,255",
+            "-i",
+            soundFile,
+            "-o",
+            outputFilename,
+        ]
+        command.core.clearComponents()
+        command.parseArgs()
+
+        with qtbot.waitSignal(command.worker.videoCreated, timeout=10000):
+            print(f"Test Video created at {outputFilename}")
+
+        assert os.path.getsize(outputFilename) > 200000
+    assert loaded == [False, True]
+
+
+def test_commandline_segmented_export_frame_count(qtbot, command):
+    """Segments add up to as many frames as a serial export of the same audio"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    frameCounts = []
+    for segments in ("1", "3"):
+        outputFilename = os.path.join(outputDir, "output%s.mp4" % segments)
+        sys.argv = [
+            "",
+            "-c",
+            "0",
+            "classic",
+            "color=255,255,255",
+            "-i",
+            soundFile,
+            "-o",
+            outputFilename,
+            "--segments",
+            segments,
+        ]
+        command.core.clearComponents()
+        command.parseArgs()
+
+        with qtbot.waitSignal(command.worker.videoCreated, timeout=30000):
+            print(f"Test Video created at {outputFilename}")
+
+        frameCounts.append(len(readFrameHashes(outputFilename)))
+    assert frameCounts == [122, 122]
+
+
+def test_commandline_resumable_export(qtbot, command):
+    """Export with segments kept beside the output until it is complete"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "classic",
+        "color=255,255,255",
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+        "--resume",
+    ]
+    # the components of an earlier export
+    command.core.clearComponents()
+    command.parseArgs()
+    assert command.worker.resumable
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=30000):
+        print(f"Test Video created at {outputFilename}")
+
+    assert os.path.getsize(outputFilename) > 200000
+    assert os.listdir(outputDir) == ["output.mp4"]
+
+
+def watchSegments(monkeypatch):
+    """
+    Returns a list which gets the segments found complete by each segmented
+    export and the stat of each segment file as they are about to be joined.
+    A copy of the work directory is kept for seedSegments()
+    """
+    joins = []
+    concatSegments = SegmentedExport.concatSegments
+
+    def checkSegments(self):
+        joins.append(
+            (
+                self.completeSegments,
+                [os.stat(segment.path) for segment in self.segments],
+            )
+        )
+        shutil.copytree(self.workDir, self.workDir + ".seed", dirs_exist_ok=True)
+        return concatSegments(self)
+
+    monkeypatch.setattr(SegmentedExport, "concatSegments", checkSegments)
+    return joins
+
+
+def seedSegments(outputFilename):
+    """Puts back the work directory of the last export without its 2nd segment"""
+    workDir = outputFilename + ".segments"
+    os.replace(workDir + ".seed", workDir)
+    os.remove(os.path.join(workDir, "segment1.mkv"))
+    return os.stat(os.path.join(workDir, "segment0.mkv"))
+
+
+def exportResumable(qtbot, command, outputFilename, color):
+    """Runs a resumable export of two segments"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "classic",
+        "color=%s" % color,
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+        "--segments",
+        "2",
+        "--resume",
+    ]
+    # the components of an earlier export
+    command.core.clearComponents()
+    command.parseArgs()
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=30000):
+        print(f"Test Video created at {outputFilename}")
+
+    assert os.path.getsize(outputFilename) > 200000
+
+
+def test_commandline_resumed_export_reuses_segments(qtbot, command, monkeypatch):
+    """A complete segment of the same project and audio isn't rendered again"""
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    joins = watchSegments(monkeypatch)
+    exportResumable(qtbot, command, outputFilename, "255,255,255")
+    seededStat = seedSegments(outputFilename)
+
+    exportResumable(qtbot, command, outputFilename, "255,255,255")
+    completeSegments, segmentStats = joins[-1]
+    assert [segment.segNo for segment in completeSegments] == [0]
+    assert segmentStats[0].st_ino == seededStat.st_ino
+    assert segmentStats[0].st_mtime_ns == seededStat.st_mtime_ns
+
+
+def test_commandline_resumed_export_discards_old_segments(
+    qtbot, command, monkeypatch
+):
+    """Segments of an export of a different project are rendered again"""
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    joins = watchSegments(monkeypatch)
+    exportResumable(qtbot, command, outputFilename, "255,255,255")
+    seededStat = seedSegments(outputFilename)
+
+    exportResumable(qtbot, command, outputFilename, "0,0,255")
+    completeSegments, segmentStats = joins[-1]
+    assert completeSegments == []
+    assert segmentStats[0].st_ino != seededStat.st_ino
+
+
+def test_commandline_partial_export(qtbot, command):
+    """Export two seconds from the middle of the audio"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "classic",
+        "color=255,255,255",
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+        "--start",
+        "1.5",
+        "--end",
+        "3.5",
+    ]
+    command.parseArgs()
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=10000):
+        print(f"Test Video created at {outputFilename}")
+
+    # one second of audio before the start is analyzed but not exported
+    assert command.worker.firstFrameNo == 30
+    assert command.worker.audioStart == 0.5
+    assert 2.0 <= getAudioDuration(outputFilename) < 2.5
+
+
+def test_commandline_still_image_export(qtbot, command):
+    """A video whose components are all static is encoded from one image"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "color",
+        "color=255,255,255",
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+    ]
+    command.parseArgs()
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=10000):
+        print(f"Test Video created at {outputFilename}")
+
+    # no frames were piped to FFmpeg
+    assert command.worker.out_pipe is None
+    assert getAudioDuration(outputFilename) >= 3.9
+
+
+def test_commandline_native_export(qtbot, command, monkeypatch):
+    """A video whose components FFmpeg can draw is exported by one filtergraph"""
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    outputDir = tempfile.mkdtemp(prefix="avp-export-")
+    outputFilename = os.path.join(outputDir, "output.mp4")
+    sys.argv = [
+        "",
+        "-c",
+        "0",
+        "spectrum",
+        "-c",
+        "1",
+        "color",
+        "color=255,255,255",
+        "-i",
+        soundFile,
+        "-o",
+        outputFilename,
+        "--start",
+        "1.5",
+        "--end",
+        "3.5",
+    ]
+    # FFmpeg's frames only look like the rendered ones, so it's opt-in
+    command.settings.setValue("pref_nativeExport", True)
+    exports = []
+    run = NativeExport.run
+    monkeypatch.setattr(
+        NativeExport, "run", lambda self: exports.append(self) or run(self)
+    )
+    command.parseArgs()
+    assert findFfmpegLayers(command.core.selectedComponents) is not None
+
+    with qtbot.waitSignal(command.worker.videoCreated, timeout=20000):
+        print(f"Test Video created at {outputFilename}")
+
+    assert not command.worker.error
+    assert len(exports) == 1
+    assert 2.0 <= getAudioDuration(outputFilename) < 2.5
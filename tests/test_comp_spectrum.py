@@ -1,9 +1,11 @@
 from avp.command import Command
 from pytestqt import qtbot
 from pytest import fixture
+from avp.toolkit.ffmpeg import FfmpegAudioGraph
 from . import (
     imageDataSum,
     command,
+    getTestDataPath,
     preFrameRender,
     audioData,
 )
@@ -30,3 +32,46 @@ def test_comp_spectrum_renderFrame(coreWithSpectrumComp, audioData):
     image = comp.frameRender(0)
     comp.postFrameRender()
     assert imageDataSum(image) == 117
+
+
+def test_comp_spectrum_regionRender(coreWithSpectrumComp, audioData):
+    """regionRender gives only the scaled spectrum and its position"""
+    comp = coreWithSpectrumComp.selectedComponents[0]
+    comp.page.spinBox_scale.setValue(40)
+    preFrameRender(audioData, comp)
+    image, offset = comp.regionRender(0)
+    comp.postFrameRender()
+    assert image.size == (768, 432)
+    assert offset == (comp.x, comp.y)
+
+
+def test_comp_spectrum_shares_ffmpegAudioGraph(coreWithSpectrumComp, audioData):
+    """Spectrum and Waveform reading one FFmpeg process give the same frames"""
+    core = coreWithSpectrumComp
+    spectrum = core.selectedComponents[0]
+    core.insertComponent(
+        1, core.moduleIndexFor("Waveform"), spectrum.parent
+    )
+    spectrum, waveform = core.selectedComponents
+    spectrum.page.comboBox_filterType.setCurrentIndex(1)
+    waveform.page.comboBox_mode.setCurrentIndex(2)
+    waveform.page.lineEdit_color.setText("255,255,255")
+    frames = []
+    # without a graph, each component makes its own with one layer
+    for ffmpegAudioGraph in (
+        None,
+        FfmpegAudioGraph(getTestDataPath("inputfiles/test.ogg")),
+    ):
+        for comp in (spectrum, waveform):
+            preFrameRender(audioData, comp, ffmpegAudioGraph=ffmpegAudioGraph)
+        frames.append(
+            [
+                imageDataSum(comp.frameRender(frameNo))
+                for frameNo in range(10)
+                for comp in (spectrum, waveform)
+            ]
+        )
+        for comp in (spectrum, waveform):
+            comp.postFrameRender()
+    assert spectrum.video.graph is waveform.video.graph
+    assert frames[0] == frames[1]
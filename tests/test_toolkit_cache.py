@@ -0,0 +1,86 @@
+import os
+import numpy
+from avp.toolkit.cache import AnalysisCache
+from avp.toolkit.visualizer import SpectrumArray, SpectrumCache
+from . import audioData, getTestDataPath, MockSignal
+
+
+class MockComponent:
+    canceled = False
+
+
+def test_analysisCache_audio(tmp_path):
+    cache = AnalysisCache(str(tmp_path), 2**30)
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    key = cache.audioKey(soundFile, 0.0, None)
+    assert key != cache.audioKey(soundFile, 1.0, None)
+    assert cache.loadAudio(key) is None
+    completeAudioArray = numpy.arange(1000, dtype="int16")
+    cache.saveAudio(key, completeAudioArray, 2.5)
+    cachedArray, duration = cache.loadAudio(key)
+    assert isinstance(cachedArray, numpy.memmap)
+    assert (cachedArray == completeAudioArray).all()
+    assert duration == 2.5
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+
+def test_analysisCache_prunes_least_recently_used(tmp_path):
+    cache = AnalysisCache(str(tmp_path), 2**30)
+    for key in ("a", "b", "c"):
+        cache.saveSpectrum(key, numpy.zeros(250, dtype="float32"))
+        path = cache.path("spectrum", key)
+        os.utime(path, (0, os.stat(path).st_mtime - ord("z") + ord(key)))
+    cache.loadSpectrum("a")
+    # room for two of them
+    cache.sizeLimit = 3000
+    cache.prune()
+    assert cache.loadSpectrum("a") is not None
+    assert cache.loadSpectrum("b") is None
+    assert cache.loadSpectrum("c") is not None
+
+
+def test_spectrumCache_saves_analyses(audioData, tmp_path):
+    analysisCache = AnalysisCache(str(tmp_path), 2**30)
+    spectrumArrays = []
+    for streaming in (False, True):
+        for _ in range(2):
+            spectrumCache = SpectrumCache(
+                audioData[0],
+                MockSignal(),
+                MockSignal(),
+                streaming=streaming,
+                analysisCache=analysisCache,
+                audioKey="audio",
+            )
+            spectrumArray = spectrumCache.spectrumArray(
+                MockComponent(), 1470, 0.08, 0.8, 20, bins=range(0, 256, 4)
+            )
+            # reading the last frame completes a streaming analysis
+            spectrumArray[(len(spectrumArray) - 1) * 1470]
+            spectrumArrays.append(spectrumArray)
+    # the second time, each analysis is loaded from the cache
+    assert isinstance(spectrumArrays[1], SpectrumArray)
+    assert isinstance(spectrumArrays[1].spectra, numpy.memmap)
+    assert isinstance(spectrumArrays[3], SpectrumArray)
+    for sampleNo in range(0, len(audioData[0]), 1470):
+        spectra = [spectrumArray[sampleNo] for spectrumArray in spectrumArrays]
+        assert all((spectrum == spectra[0]).all() for spectrum in spectra)
+
+
+def test_spectrumCache_removes_incomplete_analyses(audioData, tmp_path):
+    analysisCache = AnalysisCache(str(tmp_path), 2**30)
+    spectrumCache = SpectrumCache(
+        # longer than the first batch of a StreamingSpectrumArray
+        numpy.tile(audioData[0], 4),
+        MockSignal(),
+        MockSignal(),
+        streaming=True,
+        analysisCache=analysisCache,
+        audioKey="audio",
+    )
+    spectrumArray = spectrumCache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20)
+    spectrumArray[0]
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+    # like an export which is canceled before its last frame
+    spectrumCache.close()
+    assert not os.listdir(tmp_path)
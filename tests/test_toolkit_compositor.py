@@ -0,0 +1,52 @@
+import numpy
+from PIL import Image
+from avp.toolkit.compositor import Compositor, Layer
+from avp.toolkit.frame import BlankFrame, FloodFrame
+
+
+def composite(*layers):
+    compositor = Compositor(32, 16)
+    for layer in layers:
+        compositor.addLayer(layer)
+    frameData = numpy.zeros((16, 32, 4), dtype="uint8")
+    compositor.writeInto(frameData)
+    return frameData
+
+
+def test_compositor_matches_alpha_composite():
+    """Compositor gives the same frame as chaining Image.alpha_composite"""
+    bottom = FloodFrame(32, 16, (10, 20, 30, 255))
+    top = FloodFrame(32, 16, (200, 100, 50, 128))
+    expected = numpy.asarray(Image.alpha_composite(bottom, top))
+    assert (composite(bottom, Layer(top)) == expected).all()
+
+
+def test_compositor_opaque_layer_replaces_frame():
+    """An opaque Layer hides everything beneath it"""
+    top = FloodFrame(32, 16, (1, 2, 3, 255))
+    frameData = composite(FloodFrame(32, 16, (200, 100, 50, 128)), Layer(top))
+    assert (frameData == numpy.asarray(top)).all()
+
+
+def test_compositor_skips_transparent_layer():
+    """A transparent Layer leaves the frame beneath it unchanged"""
+    bottom = FloodFrame(32, 16, (200, 100, 50, 128))
+    frameData = composite(bottom, Layer(BlankFrame(32, 16)))
+    assert (frameData == numpy.asarray(bottom)).all()
+
+
+def test_compositor_places_region_at_offset():
+    """A smaller image at an offset blends like a padded whole frame"""
+    bottom = FloodFrame(32, 16, (10, 20, 30, 255))
+    region = FloodFrame(8, 4, (200, 100, 50, 128))
+    padded = BlankFrame(32, 16)
+    padded.paste(region, (5, 6))
+    compositor = Compositor(32, 16)
+    compositor.addLayer(bottom)
+    compositor.addLayer(region, (5, 6))
+    frameData = numpy.zeros((16, 32, 4), dtype="uint8")
+    compositor.writeInto(frameData)
+    expected = numpy.asarray(Image.alpha_composite(bottom, padded))
+    assert (frameData == expected).all()
+    # the bottom layer itself is left alone
+    assert bottom.getpixel((5, 6)) == (10, 20, 30, 255)
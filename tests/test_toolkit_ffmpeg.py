@@ -1,6 +1,21 @@
+import io
+import subprocess
+import threading
+import time
 import pytest
-from avp.toolkit.ffmpeg import createFfmpegCommand
-from . import audioData, getTestDataPath, command
+from avp.toolkit import ffmpeg
+from avp.toolkit.ffmpeg import (
+    createFfmpegCommand,
+    readAudioFile,
+    probeMedia,
+    FrameWriter,
+    TimestampedFrameWriter,
+    FrameRing,
+    readFrameInto,
+    DecoderScheduler,
+    createThreadOptions,
+)
+from . import audioData, getTestDataPath, command, settings, MockVideoWorker
 
 
 def test_readAudioFile_data(audioData):
@@ -11,6 +26,83 @@ def test_readAudioFile_duration(audioData):
     assert audioData[1] == 3.95
 
 
+def test_probeMedia(settings):
+    soundFile = getTestDataPath("inputfiles/test.ogg")
+    mediaInfo = probeMedia(soundFile)
+    assert mediaInfo.duration == 3.95
+    assert [tuple(stream) for stream in mediaInfo.streams] == [
+        ("audio", "vorbis", 44100)
+    ]
+    # probed once until the file changes
+    assert probeMedia(soundFile) is mediaInfo
+    assert ffmpeg.testAudioStream(soundFile)
+
+
+def test_probeMedia_without_audio(settings):
+    imageFile = getTestDataPath("inputfiles/test.png")
+    assert probeMedia(imageFile).duration is False
+    assert not ffmpeg.testAudioStream(imageFile)
+    assert probeMedia(getTestDataPath("inputfiles/missing.ogg")).duration is False
+
+
+def test_testAudioStream_decodes_the_audio(settings):
+    """An audio stream which FFmpeg lists but can't decode isn't usable"""
+    badFile = getTestDataPath("inputfiles/undecodable.mkv")
+    assert [stream.type for stream in probeMedia(badFile).streams] == ["audio"]
+    assert not ffmpeg.testAudioStream(badFile)
+
+
+def test_readFfmpegOutput_cached_until_binary_changes(tmp_path, monkeypatch):
+    fakeBin = tmp_path / "ffmpeg"
+    cacheFile = str(tmp_path / "ffmpeg-cache.json")
+    fakeBin.write_text("#!/bin/sh\necho version 1\n")
+    fakeBin.chmod(0o755)
+    assert ffmpeg.readFfmpegOutput(str(fakeBin), cacheFile, "-version") == "version 1\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "ffmpeg",
+        "ffmpeg-cache.json",
+    ]
+
+    def checkOutput(*args, **kwargs):
+        raise AssertionError("FFmpeg was run again")
+
+    # a new process reads the output saved by the first one
+    monkeypatch.setattr(ffmpeg, "ffmpegOutputs", {})
+    with monkeypatch.context() as m:
+        m.setattr(ffmpeg, "checkOutput", checkOutput)
+        assert (
+            ffmpeg.readFfmpegOutput(str(fakeBin), cacheFile, "-version")
+            == "version 1\n"
+        )
+    fakeBin.write_text("#!/bin/sh\necho version 22\n")
+    output = ffmpeg.readFfmpegOutput(str(fakeBin), cacheFile, "-version")
+    assert output == "version 22\n"
+
+
+def test_readAudioFile_longer_than_probed(audioData, monkeypatch):
+    """The audio is read completely even if its duration is underestimated"""
+    monkeypatch.setattr(ffmpeg, "getAudioDuration", lambda filename: 0.5)
+    completeAudioArray, _ = readAudioFile(
+        getTestDataPath("inputfiles/test.ogg"), MockVideoWorker()
+    )
+    assert (completeAudioArray == audioData[0]).all()
+    assert not completeAudioArray[-44100:].any()
+
+
+@pytest.mark.parametrize("probedDuration", (3.95, 2.0))
+def test_readAudioFile_segments(audioData, monkeypatch, probedDuration):
+    """
+    Segments decoded at once join up exactly, and audio longer than probed
+    is decoded again without segments
+    """
+    monkeypatch.setattr(ffmpeg, "MIN_DECODE_SEGMENT", 0.5)
+    monkeypatch.setattr(ffmpeg, "getAudioDuration", lambda filename: probedDuration)
+    completeAudioArray, _ = readAudioFile(
+        getTestDataPath("inputfiles/test.ogg"), MockVideoWorker(), jobs=3
+    )
+    assert (completeAudioArray == audioData[0]).all()
+
+
 @pytest.mark.parametrize("width, height", ((1920, 1080), (1280, 720)))
 def test_createFfmpegCommand(command, width, height):
     command.settings.setValue("outputWidth", width)
@@ -62,3 +154,168 @@ def test_createFfmpegCommand(command, width, height):
         "mp4",
         "/tmp",
     ]
+
+
+def test_createFfmpegCommand_stillImage(command):
+    ffmpegCmd = createFfmpegCommand(
+        "test.ogg", "/tmp", command.core.selectedComponents, stillImage="frame.png"
+    )
+    assert ffmpegCmd[6:14] == [
+        "-loop",
+        "1",
+        "-framerate",
+        "1",
+        "-t",
+        "0.100",
+        "-i",
+        "frame.png",
+    ]
+    assert "rawvideo" not in ffmpegCmd
+    # but the output has the usual frame rate
+    assert ffmpegCmd[-5:-3] == ["-r", "30"]
+
+
+def test_createFfmpegCommand_timestampedFrames(command):
+    ffmpegCmd = createFfmpegCommand(
+        "test.ogg", "/tmp", command.core.selectedComponents, timestampedFrames=True
+    )
+    assert ffmpegCmd[6:13] == ["-f", "matroska", "-t", "0.100", "-an", "-i", "-"]
+    assert ffmpegCmd[-5:-3] == ["-fps_mode", "vfr"]
+
+
+class MockPipe:
+    """Pretends to be a Popen object with a stdin pipe"""
+
+    def __init__(self, stdin=None):
+        self.stdin = io.BytesIO() if stdin is None else stdin
+
+
+def test_frameWriter_writes_in_order():
+    pipe = MockPipe()
+    written = []
+    writer = FrameWriter(pipe, 2)
+    for i in range(10):
+        assert writer.write(bytes([i]) * 4, lambda i=i: written.append(i))
+    writer.close()
+    assert pipe.stdin.getvalue() == b"".join(bytes([i]) * 4 for i in range(10))
+    assert written == list(range(10))
+    assert 0 < writer.highWaterMark <= 2
+
+
+def test_frameWriter_stops_after_broken_pipe():
+    stdin = io.BytesIO()
+    stdin.close()
+    written = []
+    writer = FrameWriter(MockPipe(stdin), 2)
+    writer.write(b"1234", lambda: written.append(0))
+    writer.close()
+    assert writer.error is not None
+    assert not writer.write(b"1234", lambda: written.append(1))
+    assert written == [0, 1]
+
+
+def test_timestampedFrameWriter_skips_repeated_frames():
+    pipe = subprocess.Popen(
+        ["ffmpeg", "-v", "error", "-f", "matroska", "-i", "-"]
+        + ["-c", "copy", "-f", "framecrc", "-"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    # the last second of frames (frames 8 and 9) is always sent
+    writer = TimestampedFrameWriter(pipe, 2, 4, 2, 2, 10)
+    for value in (0, 1, 1, 1, 1, 1, 1, 2, 2, 2):
+        writer.write(bytes([value]) * 32)
+    writer.close()
+    pipe.stdin.close()
+    output = pipe.stdout.read().decode()
+    assert pipe.wait() == 0
+    assert writer.skippedFrames == 5
+    frames = [line.split(",") for line in output.splitlines() if line[0] != "#"]
+    timestamps = [int(frame[2]) for frame in frames]
+    assert timestamps == [0, 500000000, 3500000000, 4000000000, 4500000000]
+    assert [int(frame[4]) for frame in frames] == [32] * 5
+
+
+def test_frameRing_reads_ahead_into_its_slots():
+    ring = FrameRing(2, 4)
+    output = io.BytesIO(b"".join(bytes([i]) * 4 for i in range(4)) + b"12")
+    for _ in range(2):
+        assert readFrameInto(output, ring.slot()) == 4
+        ring.publish()
+    assert ring.buffered == 2
+    frame = ring.get(1)
+    assert bytes(frame) == bytes([1]) * 4
+    # frame 0 was released, so frame 2 is read into its slot
+    assert readFrameInto(output, ring.slot()) == 4
+    ring.publish()
+    assert bytes(frame) == bytes([1]) * 4
+    lastFrame = ring.get(2)
+    assert bytes(lastFrame) == bytes([2]) * 4
+    assert ring.stalls == 0
+    # a short read is the end of the pipe
+    assert readFrameInto(output, ring.slot()) == 4
+    assert readFrameInto(output, ring.slot()) == 2
+    # frame 3 was never published, so it's waited for until the ring closes
+    frames = []
+    thread = threading.Thread(target=lambda: frames.append(ring.get(3)))
+    thread.start()
+    while ring.stalls == 0:
+        time.sleep(0.01)
+    ring.close()
+    thread.join()
+    assert frames == [None]
+    assert ring.slot() is None
+    # the last frame returned is intact, so it can stand in for the rest
+    assert bytes(lastFrame) == bytes([2]) * 4
+
+
+def test_frameRing_grows_while_its_group_waits():
+    group = []
+    ahead = FrameRing(2, 1, group)
+    behind = FrameRing(2, 1, group)
+    for i in range(2):
+        ahead.slot()[0] = i
+        ahead.publish()
+    frames = []
+    thread = threading.Thread(target=lambda: frames.append(behind.get(0)))
+    thread.start()
+    # FFmpeg writes frames of ahead until it writes the one requested
+    for i in range(2, 5):
+        ahead.slot()[0] = i
+        ahead.publish()
+    behind.slot()[0] = 0
+    behind.publish()
+    thread.join()
+    assert len(frames) == 1
+    assert len(ahead.frames) == 8
+    assert [int(ahead.get(i)[0]) for i in range(5)] == list(range(5))
+
+
+def test_decoderScheduler_gives_turns_to_starved_videos():
+    scheduler = DecoderScheduler(1)
+    starved = FrameRing(4, 1)
+    readAhead = FrameRing(4, 1)
+    for _ in range(2):
+        readAhead.slot()
+        readAhead.publish()
+    order = []
+
+    def decode(frames, name):
+        with scheduler.turn(frames):
+            order.append(name)
+
+    threads = [
+        threading.Thread(target=decode, args=(readAhead, "readAhead")),
+        threading.Thread(target=decode, args=(starved, "starved")),
+    ]
+    # another video has the only turn until both are waiting for it
+    with scheduler.turn(FrameRing(4, 1)):
+        for thread in threads:
+            thread.start()
+        while len(scheduler.waiting) < 2:
+            time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert order == ["starved", "readAhead"]
+    assert scheduler.running == 0
+    assert createThreadOptions(scheduler)[-1] == str(scheduler.threads)
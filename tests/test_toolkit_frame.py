@@ -1,5 +1,12 @@
 import numpy
-from avp.toolkit.frame import BlankFrame, FloodFrame
+import pytest
+from avp.toolkit.frame import (
+    BlankFrame,
+    FloodFrame,
+    FrameBuffers,
+    FrameFromBytes,
+    copyFrameInto,
+)
 
 
 def test_blank_frame():
@@ -12,3 +19,26 @@ def test_flood_frame():
     assert numpy.asarray(FloodFrame(1920, 1080, (1, 1, 1, 1)), dtype="int32").sum() == (
         1920 * 1080 * 4
     )
+
+
+def test_copy_frame_into_buffer():
+    """copyFrameInto gives the same bytes as tobytes without a new bytes object"""
+    frame = FloodFrame(32, 16, (10, 20, 30, 40))
+    buffers = FrameBuffers(32, 16, 1)
+    buffer = buffers.get()
+    copyFrameInto(frame, buffer)
+    assert buffer.tobytes() == frame.tobytes()
+    # the buffer is written again for the next frame
+    copyFrameInto(FloodFrame(32, 16, (50, 60, 70, 80)), buffer)
+    assert (buffer == (50, 60, 70, 80)).all()
+
+
+def test_frame_from_bytes():
+    """FrameFromBytes wraps FFmpeg's bytes and is copied before it is changed"""
+    imageData = FloodFrame(32, 16, (10, 20, 30, 40)).tobytes()
+    frame = FrameFromBytes(imageData, (32, 16))
+    assert frame.tobytes() == imageData
+    frame.paste((0, 0, 0, 0), (0, 0, 32, 16))
+    assert imageData == FloodFrame(32, 16, (10, 20, 30, 40)).tobytes()
+    with pytest.raises(ValueError):
+        FrameFromBytes(b"", (32, 16))
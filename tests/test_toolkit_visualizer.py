@@ -0,0 +1,166 @@
+import numpy
+import pytest
+from avp.toolkit import visualizer
+from avp.toolkit.visualizer import (
+    SpectrumArray,
+    SpectrumCache,
+    StreamingSpectrumArray,
+    createSpectrumArray,
+    transformData,
+)
+from . import audioData, MockSignal
+
+
+class MockComponent:
+    canceled = False
+
+
+def test_createSpectrumArray_matches_transformData(audioData, monkeypatch):
+    """Batches of frames give the same spectra as one frame at a time"""
+    # several batches, the last one ending with a shorter frame
+    monkeypatch.setattr(visualizer, "BATCH_FRAMES", 16)
+    sampleSize = 1470
+    spectrumArray = createSpectrumArray(
+        MockComponent(),
+        audioData[0],
+        sampleSize,
+        0.08,
+        0.8,
+        20,
+        MockSignal(),
+        MockSignal(),
+    )
+    assert len(audioData[0]) % sampleSize != 0
+    lastSpectrum = None
+    for i in range(0, len(audioData[0]), sampleSize):
+        lastSpectrum = transformData(
+            i, audioData[0], sampleSize, 0.08, 0.8, lastSpectrum, 20
+        ).copy()
+        assert spectrumArray[i].dtype == numpy.float32
+        assert numpy.allclose(spectrumArray[i], lastSpectrum, rtol=0, atol=1e-3)
+    assert len(spectrumArray) == len(range(0, len(audioData[0]), sampleSize))
+
+
+def test_spectrumCache_shares_identical_analyses(audioData):
+    """Components asking for the same analysis get the same spectrumArray"""
+    cache = SpectrumCache(audioData[0], MockSignal(), MockSignal())
+    spectrumArray = cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20)
+    assert cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20) is spectrumArray
+    otherArray = cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 30)
+    assert otherArray is not spectrumArray
+    assert len(cache.spectrumArrays) == 2
+
+
+def test_spectrumArray_indexed_by_sample():
+    spectrumArray = SpectrumArray(3, 1470)
+    spectrumArray.spectra[2] = 5
+    assert len(spectrumArray) == 3
+    assert (spectrumArray[2940] == 5).all()
+    for sampleNo in (1, 4410, -1470):
+        with pytest.raises(KeyError):
+            spectrumArray[sampleNo]
+
+
+def test_createSpectrumArray_half_precision(audioData):
+    spectrumArrays = [
+        createSpectrumArray(
+            MockComponent(),
+            audioData[0],
+            1470,
+            0.08,
+            0.8,
+            20,
+            MockSignal(),
+            MockSignal(),
+            dtype,
+        )
+        for dtype in ("float32", "float16")
+    ]
+    assert spectrumArrays[1].spectra.nbytes * 2 == spectrumArrays[0].spectra.nbytes
+    spectrum = spectrumArrays[1][1470 * 4]
+    assert spectrum.dtype == numpy.float32
+    assert numpy.allclose(spectrum, spectrumArrays[0][1470 * 4], rtol=1e-3, atol=0.1)
+
+
+@pytest.mark.parametrize("bins", [(144,), range(0, 256, 4)])
+def test_createSpectrumArray_selected_bins(audioData, bins):
+    """Only the selected bins are stored, with the same values as all bins"""
+    spectrumArrays = [
+        createSpectrumArray(
+            MockComponent(),
+            audioData[0],
+            1470,
+            0.08,
+            0.8,
+            20,
+            MockSignal(),
+            MockSignal(),
+            bins=selectedBins,
+        )
+        for selectedBins in (None, bins)
+    ]
+    assert spectrumArrays[1].spectra.shape == (len(spectrumArrays[0]), len(bins))
+    for sampleNo in range(0, len(audioData[0]), 1470):
+        spectrum = spectrumArrays[1][sampleNo]
+        assert numpy.allclose(
+            spectrum[list(bins)],
+            spectrumArrays[0][sampleNo][list(bins)],
+            rtol=0,
+            atol=1e-3,
+        )
+        assert not numpy.delete(spectrum, list(bins)).any()
+        # the expanded spectrum is reused while the frame is read
+        assert spectrumArrays[1][sampleNo] is spectrum
+
+
+def test_spectrumCache_shares_analyses_of_more_bins(audioData):
+    cache = SpectrumCache(audioData[0], MockSignal(), MockSignal())
+    spectrumArray = cache.spectrumArray(
+        MockComponent(), 1470, 0.08, 0.8, 20, bins=range(0, 256, 4)
+    )
+    assert (
+        cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20, bins=(0, 144))
+        is spectrumArray
+    )
+    assert (
+        cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20, bins=(1,))
+        is not spectrumArray
+    )
+
+
+@pytest.mark.parametrize("bins", [None, range(0, 256, 4)])
+def test_streamingSpectrumArray_matches_createSpectrumArray(
+    audioData, monkeypatch, bins
+):
+    monkeypatch.setattr(visualizer, "BATCH_FRAMES", 16)
+    spectrumArray = createSpectrumArray(
+        MockComponent(),
+        audioData[0],
+        1470,
+        0.08,
+        0.8,
+        20,
+        MockSignal(),
+        MockSignal(),
+        bins=bins,
+    )
+    streamingArray = StreamingSpectrumArray(audioData[0], 1470, 0.08, 0.8, 20, bins)
+    assert len(streamingArray) == len(spectrumArray)
+    # in order, skipping ahead, looking back and going back to the start
+    frameNos = list(range(len(spectrumArray)))
+    frameNos += [0, 40, 20, 18, 60, 5, len(spectrumArray) - 1]
+    for frameNo in frameNos:
+        assert (
+            streamingArray[frameNo * 1470] == spectrumArray[frameNo * 1470]
+        ).all()
+        assert len(streamingArray.batches) <= 2
+    with pytest.raises(KeyError):
+        streamingArray[len(spectrumArray) * 1470]
+
+
+def test_spectrumCache_streaming(audioData):
+    cache = SpectrumCache(audioData[0], MockSignal(), MockSignal(), streaming=True)
+    spectrumArray = cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20)
+    assert isinstance(spectrumArray, StreamingSpectrumArray)
+    assert not spectrumArray.batches
+    assert cache.spectrumArray(MockComponent(), 1470, 0.08, 0.8, 20) is spectrumArray